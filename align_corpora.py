@@ -23,21 +23,47 @@ study Tweets are discarded.
 ===============================================================================
 """
 
-import dateutil.parser
 import csv
 import argparse
-from count_timebins import bin_time
-import random
+import sys
+import operator
+import warnings
+import mmap
+from count_timebins import bin_time, parse_time
+from parallel_io import IO_BUFFER_SIZE
+import numpy as np
+import functools
+import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of seconds in each unit that can be used to define timebins
+UNIT_SECONDS = {
+    "days": 86400,
+    "hours": 3600,
+    "minutes": 60,
+    "seconds": 1
+}
+
+# UTC offset of timestamps ending in Z
+UTC_OFFSET = datetime.timedelta(0)
+
+# Number of paired rows to collect before writing them to the output file
+WRITE_BATCH_SIZE = 10000
 
 
 def process_corpus(corpus_filepath, timebin_unit="hours", timebin_interval=1,
                    time_column="tweet.created_at", use_labels=True, 
-                   label_column="label", shuffle=False):
+                   label_column="label", shuffle=False, seed=None, offsets_only=False):
     """Reads a CSV corpus of Tweets and groups it by timebin and label,
-    returning a dictionary that maps from timebin start time to a dictionary
-    that maps from label to Tweets in that timebin with that label. If labels
+    returning the CSV header and a dictionary that maps from timebin key
+    (see get_timebin_key) to a dictionary that maps from label to Tweets in
+    that timebin with that label. Each Tweet is a tuple of column values, in the
+    order given by the header (or, if offsets_only is True, the byte offset at
+    which the Tweet's row starts in the CSV file; see read_row_at_offset). If labels
     are not being used to group Tweets, the inner dictionary (mapping from
-    label to Tweets) has None as the key.
+    label to Tweets) has None as the key. Both dictionaries are defaultdicts,
+    so looking up a timebin or label with no Tweets gives an empty list.
     
     Arguments
     ---------
@@ -54,35 +80,105 @@ def process_corpus(corpus_filepath, timebin_unit="hours", timebin_interval=1,
                   where the label of the Tweet is stored
     shuffle: bool (default False); whether to shuffle the Tweets within each
              group prior to returning the dictionary
+    seed: int (default None); the random seed to use for shuffling
+    offsets_only: bool (default False); whether to represent Tweets by their
+                  offsets in the CSV file rather than their column values,
+                  which uses much less memory for large corpora
     """
-    grouped_tweets = dict()
-    with open(corpus_filepath, encoding="utf-8") as in_file:
-        reader = csv.DictReader(in_file)
+    if offsets_only:
+        in_file = open(corpus_filepath, "rb", buffering=IO_BUFFER_SIZE)
+        reader = read_rows_with_offsets(in_file)
+    else:
+        in_file = open(corpus_filepath, encoding="utf-8", buffering=IO_BUFFER_SIZE)
+        reader = ((None, row) for row in csv.reader(in_file))
+    
+    with in_file:
+        (_, header) = next(reader)
+        time_index = header.index(time_column)
+        if use_labels:
+            label_index = header.index(label_column)
         
-        for row in reader:
-            
-            time = row[time_column]
-            timebin_start = get_timebin_start(time, timebin_unit, timebin_interval)
-            if timebin_start not in grouped_tweets:
-                grouped_tweets[timebin_start] = dict()
-            
-            label = None
+        # Rows are stored as tuples, which take less memory than lists;
+        # labels are interned, since there are only a few distinct labels
+        # but one copy of the label string for every row
+        tweets = list()
+        times = list()
+        labels = list()
+        for (offset, row) in reader:
+            times.append(row[time_index])
             if use_labels:
-                label = row[label_column]
-            if label not in grouped_tweets[timebin_start]:
-                grouped_tweets[timebin_start][label] = list()
-            
-            grouped_tweets[timebin_start][label].append(row)
+                row[label_index] = sys.intern(row[label_index])
+                labels.append(row[label_index])
+            if offsets_only:
+                tweets.append(offset)
+            else:
+                tweets.append(tuple(row))
+    
+    # Get the timebins of all Tweets at once, which is much faster than one at a time
+    timebin_keys = get_timebin_keys(times, timebin_unit, timebin_interval)
+    del times
+    
+    # Without labels, Tweets are first only grouped by timebin,
+    # and are given the None label afterwards
+    if use_labels:
+        grouped_tweets = defaultdict(functools.partial(defaultdict, list))
+        for (timebin_key, label, tweet) in zip(timebin_keys, labels, tweets):
+            grouped_tweets[timebin_key][label].append(tweet)
+    else:
+        grouped_tweets = defaultdict(list)
+        for (timebin_key, tweet) in zip(timebin_keys, tweets):
+            grouped_tweets[timebin_key].append(tweet)
+        grouped_tweets = defaultdict(functools.partial(defaultdict, list),
+                                     {timebin_key: defaultdict(list, {None: tweets})
+                                      for (timebin_key, tweets) in grouped_tweets.items()})
     
     if shuffle:
-        shuffle_grouped_tweets(grouped_tweets)
+        shuffle_grouped_tweets(grouped_tweets, np.random.default_rng(seed))
     
-    return grouped_tweets
+    return (header, grouped_tweets)
+
+
+def read_rows_with_offsets(in_file):
+    """A generator that reads a CSV file opened in binary mode, and yields
+    the byte offset at which each row starts along with the row itself
+    (as a list of column values).
+    """
+    offset = 0
+    def read_lines():
+        nonlocal offset
+        for line in in_file:
+            offset += len(line)
+            yield line.decode("utf-8")
+    
+    # The reader only takes as many lines as it needs for each row,
+    # so the offset at the end of one row is the start of the next
+    reader = csv.reader(read_lines())
+    while True:
+        row_offset = offset
+        row = next(reader, None)
+        if row is None:
+            return
+        yield (row_offset, row)
+
+
+def read_row_at_offset(corpus_file, offset):
+    """Reads a single row of a CSV file (as a tuple of column values), starting
+    from a byte offset given by read_rows_with_offsets.
+    
+    Arguments
+    ---------
+    corpus_file: mmap.mmap (or a file opened in binary mode); the CSV file
+    offset: int; the offset at which the row starts
+    """
+    corpus_file.seek(offset)
+    lines = (line.decode("utf-8") for line in iter(corpus_file.readline, b""))
+    return tuple(next(csv.reader(lines)))
 
 
+@functools.lru_cache(maxsize=None)
 def get_timebin_start(time_str, timebin_unit, timebin_interval):
     """Returns a string representing the start time of the timebin in which a Tweet
-    is included.
+    is included. Results are cached, since many Tweets share the same timestamp.
     
     Arguments
     ---------
@@ -92,20 +188,136 @@ def get_timebin_start(time_str, timebin_unit, timebin_interval):
     timebin_interval: int; the number of time units to be included
                       in a timebin
     """
-    time_parsed = dateutil.parser.isoparse(time_str)
+    time_parsed = parse_time(time_str)
     timebin = bin_time(time_parsed, interval=timebin_interval, unit=timebin_unit)
     start_time = timebin.split("_")[0]
     return start_time
 
 
-def shuffle_grouped_tweets(grouped_tweets):
-    """Shuffles the grouped Tweets at the innermost layer of a 2-level dictionary"""
+@functools.lru_cache(maxsize=None)
+def get_timebin_key(time_str, timebin_unit, timebin_interval):
+    """Returns a key for the timebin in which a Tweet is included, as a tuple of
+    an integer index and the UTC offset of the Tweet's time (None if the time is
+    naive). Timebins are defined in the same way as in count_timebins.floor_time
+    (by local time, keeping the UTC offset), so Tweets share a key exactly when
+    get_timebin_start gives them the same start time. Within a UTC offset, later
+    timebins have larger indices. Results are cached, since many Tweets share
+    the same timestamp.
+    
+    Arguments
+    ---------
+    time_str: str; the timestamp at which the Tweet was posted
+    timebin_unit: str; the unit in which timebins are defined
+                  (valid options: "days", "hours", "minutes", "seconds")
+    timebin_interval: int; the number of time units to be included
+                      in a timebin
+    """
+    (bin_seconds, bins_per_day) = get_timebin_size(timebin_unit, timebin_interval)
+    time_parsed = parse_time(time_str)
+    time_offset = time_parsed.replace(tzinfo=None) - datetime.datetime.min
+    if timebin_unit == "days":
+        timebin_index = time_offset.days // timebin_interval
+    else:
+        timebin_index = time_offset.days * bins_per_day + time_offset.seconds // bin_seconds
+    return (timebin_index, time_parsed.utcoffset())
+
+
+def get_timebin_keys(time_strs, timebin_unit, timebin_interval):
+    """Returns a list of the timebin keys (see get_timebin_key) for a list of
+    timestamps. The timestamps are parsed and binned all at once with numpy where
+    possible (for naive timestamps and those ending in Z); if any timestamp has
+    another UTC offset (which numpy would convert to UTC, rather than binning by
+    local time), or numpy cannot parse it, each timestamp is binned separately
+    with get_timebin_key instead.
+    
+    Arguments
+    ---------
+    time_strs: list(str); the timestamps at which the Tweets were posted
+    timebin_unit: str; the unit in which timebins are defined
+                  (valid options: "days", "hours", "minutes", "seconds")
+    timebin_interval: int; the number of time units to be included
+                      in a timebin
+    """
+    (bin_seconds, bins_per_day) = get_timebin_size(timebin_unit, timebin_interval)
+    utc_flags = [time_str.endswith("Z") for time_str in time_strs]
+    try:
+        with warnings.catch_warnings():
+            # numpy warns about (but still parses) timestamps with UTC offsets
+            warnings.simplefilter("error", DeprecationWarning)
+            times = np.array([time_str[:-1] if is_utc else time_str
+                              for (time_str, is_utc) in zip(time_strs, utc_flags)],
+                             dtype="datetime64[s]")
+    except (ValueError, DeprecationWarning):
+        return [get_timebin_key(time_str, timebin_unit, timebin_interval) for time_str in time_strs]
+    
+    # Convert from seconds since 1970 to days and seconds since datetime.datetime.min
+    (days, seconds) = np.divmod(times.astype(np.int64), UNIT_SECONDS["days"])
+    days += (datetime.datetime(1970, 1, 1) - datetime.datetime.min).days
+    if timebin_unit == "days":
+        timebin_indices = days // timebin_interval
+    else:
+        timebin_indices = days * bins_per_day + seconds // bin_seconds
+    return [(timebin_index, UTC_OFFSET if is_utc else None)
+            for (timebin_index, is_utc) in zip(timebin_indices.tolist(), utc_flags)]
+
+
+def get_timebin_start_from_key(timebin_key, timebin_unit, timebin_interval):
+    """Returns a string representing the start time of the timebin with a given
+    key (see get_timebin_key), in the same format as get_timebin_start.
+    
+    Arguments
+    ---------
+    timebin_key: (int, datetime.timedelta); the index and UTC offset of the timebin
+    timebin_unit: str; the unit in which timebins are defined
+                  (valid options: "days", "hours", "minutes", "seconds")
+    timebin_interval: int; the number of time units to be included
+                      in a timebin
+    """
+    (timebin_index, utc_offset) = timebin_key
+    (bin_seconds, bins_per_day) = get_timebin_size(timebin_unit, timebin_interval)
+    if timebin_unit == "days":
+        time_offset = datetime.timedelta(days=timebin_index * timebin_interval)
+    else:
+        (days, day_bin) = divmod(timebin_index, bins_per_day)
+        time_offset = datetime.timedelta(days=days, seconds=day_bin * bin_seconds)
+    start_time = datetime.datetime.min + time_offset
+    if utc_offset is not None:
+        start_time = start_time.replace(tzinfo=datetime.timezone(utc_offset))
+    return start_time.isoformat()
+
+
+@functools.lru_cache(maxsize=None)
+def get_timebin_size(timebin_unit, timebin_interval):
+    """Returns the length of a timebin in seconds, and the number of timebins
+    that start within each day (timebins shorter than a day restart at midnight).
+    
+    Arguments
+    ---------
+    timebin_unit: str; the unit in which timebins are defined
+                  (valid options: "days", "hours", "minutes", "seconds")
+    timebin_interval: int; the number of time units to be included
+                      in a timebin
+    """
+    if timebin_interval < 1 or not isinstance(timebin_interval, int):
+        raise Exception("Invalid timebin_interval parameter: {}".format(timebin_interval))
+    if timebin_unit not in UNIT_SECONDS:
+        raise Exception("Unknown timebin_unit: {}".format(timebin_unit))
+    
+    bin_seconds = UNIT_SECONDS[timebin_unit] * timebin_interval
+    bins_per_day = -(-UNIT_SECONDS["days"] // bin_seconds)
+    return (bin_seconds, bins_per_day)
+
+
+def shuffle_grouped_tweets(grouped_tweets, rng):
+    """Shuffles the grouped Tweets at the innermost layer of a 2-level dictionary,
+    using a numpy random generator (which shuffles lists faster than the random module)"""
     for labeled_tweets in grouped_tweets.values():
         for tweets in labeled_tweets.values():
-            random.shuffle(tweets)
+            rng.shuffle(tweets)
 
 
-def pair_tweets(study_groups, reference_groups, label_hierarchy=None):
+def pair_tweets(study_groups, reference_groups, label_hierarchy=None,
+                timebin_unit="hours", timebin_interval=1):
     """A generator that yields one pair of Tweets across a study and reference corpus
     at a time, matched by group. If there are leftover reference Tweets
     in a group after pairing all the study Tweets in that group, these leftovers 
@@ -121,52 +333,73 @@ def pair_tweets(study_groups, reference_groups, label_hierarchy=None):
     Arguments
     ---------
     study_groups: dict; a nested dictionary of grouped Tweets in the study corpus,
-                  mapping from timebin start, to label, to a list of Tweets.
+                  mapping from timebin key, to label, to a list of Tweets.
     reference_groups: dict; a nested dictionary of grouped Tweets in the reference corpus,
-                      mapping from timebin start, to label, to a list of Tweets.
+                      mapping from timebin key, to label, to a list of Tweets.
     label_hierarchy: a list/tuple of the labels in the corpora, arranged from
                      lowest-level (with most filtering applied) to highest-level
                      (with least filtering applied); for example, ["included",
                      "tweet-excluded", "user-excluded"]. This hierarchy is used
                      to determine where Tweets can backfill. If no list is provided,
                      no backfilling is permitted.
+    timebin_unit: str (default "hours"); the unit in which timebins are defined
+                  (used to name the pairs by the start time of their timebin)
+    timebin_interval: int (default 1); the number of time units to be included
+                      in a timebin
     """
-    for timebin_start in study_groups:
+    for timebin_key in study_groups:
+        pair_id_prefix = get_timebin_start_from_key(timebin_key, timebin_unit, timebin_interval) + "_"
         tweet_number = 0
         labels = label_hierarchy
         if label_hierarchy is None:
-            labels = list(study_groups[timebin_start].keys())
+            labels = list(study_groups[timebin_key].keys())
+        
+        # Tweets are taken from the end of each group, so each group is reversed
+        # once; the position of the next unused Tweet in each reversed reference
+        # group is kept, so that leftovers can be used for backfilling
+        reversed_reference_groups = dict()
+        reference_positions = dict()
         
         for (label_index, label) in enumerate(labels):
-            study_tweets = study_groups[timebin_start][label]
-            reference_tweets = reference_groups[timebin_start][label]
+            study_tweets = study_groups[timebin_key][label][::-1]
+            study_position = 0
+            reference_label = label
             
-            # Pair each study Tweet
-            while study_tweets:
-                study_tweet = study_tweets.pop()
-                tweet_number += 1
-                pair_id = "{}_{}".format(timebin_start, tweet_number)
+            # Pair as many study Tweets as possible with reference Tweets with this label,
+            # then backfill from higher-level labels if there are study Tweets left over
+            while True:
+                if reference_label not in reversed_reference_groups:
+                    reversed_reference_groups[reference_label] = reference_groups[timebin_key][reference_label][::-1]
+                reference_tweets = reversed_reference_groups[reference_label]
+                reference_position = reference_positions.get(reference_label, 0)
+                num_pairs = min(len(study_tweets) - study_position, len(reference_tweets) - reference_position)
+                
+                for (study_tweet, reference_tweet) in zip(study_tweets[study_position:study_position + num_pairs],
+                                                          reference_tweets[reference_position:reference_position + num_pairs]):
+                    tweet_number += 1
+                    pair_id = pair_id_prefix + str(tweet_number)
+                    yield (study_tweet, reference_tweet, pair_id, label)
                 
-                # If there aren't any reference Tweets with this label,
-                # backfill from higher-level labels
-                while label_hierarchy and label_index > 0 and not reference_tweets:
-                    label_index -= 1
-                    reference_tweets = reference_groups[timebin_start][label_hierarchy[label_index]]
+                study_position += num_pairs
+                reference_positions[reference_label] = reference_position + num_pairs
                 
-                # Get a reference Tweet and return the pair of Tweets
                 # If no reference Tweet is available, move on to the next study group
-                if reference_tweets:
-                    reference_tweet = reference_tweets.pop()
-                    yield (study_tweet, reference_tweet, pair_id, label)
-                else:
+                # (the number of the first discarded study Tweet is skipped)
+                if study_position == len(study_tweets):
+                    break
+                if not label_hierarchy or label_index == 0:
+                    tweet_number += 1
                     break
+                label_index -= 1
+                reference_label = label_hierarchy[label_index]
 
 
-def rename_columns(row, corpus_name, label_column="label"):
-    """Renames the columns in a csv row dictionary, to prepend corpus name and exclude label"""
-    renamed_row = {"{}_{}".format(corpus_name, col_name): value for (col_name, value) in row.items()
-                   if col_name != label_column}
-    return renamed_row
+def get_column_selector(columns):
+    """Returns a function that picks out the values in the given columns of a row, as a tuple"""
+    if len(columns) == 1:
+        (column,) = columns
+        return lambda row: (row[column],)
+    return operator.itemgetter(*columns)
 
 
 if __name__ == "__main__":
@@ -183,40 +416,63 @@ if __name__ == "__main__":
     parser.add_argument("--unlabeled", dest="use_labels", action="store_false", help="Do not group Tweets by label")
     parser.add_argument("--id-column", default="pair_id", type=str, help="Name of column where paired Tweet IDs will be stored")
     parser.add_argument("--seed", default=0, type=int, help="Random seed")
+    parser.add_argument("--low-memory", dest="offsets_only", action="store_true", help="Only keep the positions of \
+                        Tweets in the corpus files in memory while pairing, and read the Tweets back from the files \
+                        when saving pairs (slower, but uses much less memory for large corpora)")
     args = parser.parse_args()
     
-    # Set random seed, to ensure reproducibility
-    random.seed(args.seed)
+    # Group Tweets, reading the two corpora at the same time
+    # (the reference corpus is shuffled using the random seed, to ensure reproducibility)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        study_future = executor.submit(process_corpus, args.study_path, timebin_unit=args.timebin_unit,
+                                       timebin_interval=args.timebin_interval, time_column=args.time_column,
+                                       use_labels=args.use_labels, label_column=args.label_column, shuffle=False,
+                                       offsets_only=args.offsets_only)
+        reference_future = executor.submit(process_corpus, args.reference_path, timebin_unit=args.timebin_unit,
+                                           timebin_interval=args.timebin_interval, time_column=args.time_column,
+                                           use_labels=args.use_labels, label_column=args.label_column, shuffle=True,
+                                           seed=args.seed, offsets_only=args.offsets_only)
+        (study_header, study_groups) = study_future.result()
+        (reference_header, reference_groups) = reference_future.result()
     
-    # Group Tweets
-    study_groups = process_corpus(args.study_path, timebin_unit=args.timebin_unit, timebin_interval=args.timebin_interval,
-                   time_column=args.time_column, use_labels=args.use_labels, label_column=args.label_column, shuffle=False)
-    reference_groups = process_corpus(args.reference_path, timebin_unit=args.timebin_unit, timebin_interval=args.timebin_interval,
-                       time_column=args.time_column, use_labels=args.use_labels, label_column=args.label_column, shuffle=True)
-    
-    # Get column headers for output file
-    with open(args.study_path, encoding="utf-8") as in_file:
-        reader = csv.reader(in_file)
-        generic_headers = next(reader)
+    # Get column headers for output file, and functions to pick out the output columns from each corpus
+    generic_headers = study_header
     if args.use_labels:
         generic_headers = [header for header in generic_headers if header != args.label_column]
-    headers = ["{}_{}".format(corpus, header) for corpus in ["study", "reference"] for header in generic_headers]
+    select_study_columns = get_column_selector([study_header.index(header) for header in generic_headers])
+    select_reference_columns = get_column_selector([reference_header.index(header) for header in generic_headers])
+    headers = [corpus + "_" + header for corpus in ["study", "reference"] for header in generic_headers]
     headers.append(args.id_column)
     if args.use_labels:
         headers.append(args.label_column)
     
+    # In low-memory mode, Tweets are read back from the corpus files when they are saved
+    if args.offsets_only:
+        with open(args.study_path, "rb") as study_file, open(args.reference_path, "rb") as reference_file:
+            study_map = mmap.mmap(study_file.fileno(), 0, access=mmap.ACCESS_READ)
+            reference_map = mmap.mmap(reference_file.fileno(), 0, access=mmap.ACCESS_READ)
+    
     # Create output file
-    with open(output_path, "w", encoding="utf-8", newline="") as out_file:
-        writer = csv.DictWriter(out_file, fieldnames=headers)
-        writer.writeheader()
+    with open(args.output_path, "w", encoding="utf-8", newline="", buffering=IO_BUFFER_SIZE) as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow(headers)
         
-        # Pair Tweets and save them
-        for (study_cols, reference_cols, pair_id, label) in pair_tweets(study_groups, reference_groups, args.label_hierarchy):
-            study_cols = rename_columns(study_cols, "study", label_column=args.label_column)
-            reference_cols = rename_columns(reference_cols, "reference", label_column=args.label_column)
-            row = dict(**study_cols, **reference_cols)
-            row[args.id_column] = pair_id
+        # Pair Tweets and save them, a batch of rows at a time
+        tweet_pairs = pair_tweets(study_groups, reference_groups, args.label_hierarchy,
+                                  timebin_unit=args.timebin_unit, timebin_interval=args.timebin_interval)
+        rows = list()
+        for (study_tweet, reference_tweet, pair_id, label) in tweet_pairs:
+            if args.offsets_only:
+                study_tweet = read_row_at_offset(study_map, study_tweet)
+                reference_tweet = read_row_at_offset(reference_map, reference_tweet)
+            row = select_study_columns(study_tweet) + select_reference_columns(reference_tweet)
             if args.use_labels:
-                row[args.label_column] = label
+                row += (pair_id, label)
+            else:
+                row += (pair_id,)
             
-            writer.writerow(row)
\ No newline at end of file
+            rows.append(row)
+            if len(rows) == WRITE_BATCH_SIZE:
+                writer.writerows(rows)
+                rows = list()
+        writer.writerows(rows)
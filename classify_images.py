@@ -28,26 +28,36 @@ import os
 
 import numpy as np
 import tensorflow as tf
-from tensorflow import keras
 import tensorflow_hub as hub
 
 from PIL import Image
-from urllib import request
+import urllib3
 from io import BytesIO
 import csv
-from collections import ChainMap
-from datetime import datetime, timezone
+from collections import ChainMap, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from datetime import datetime
 from tzlocal import get_localzone
 
 from extract_tweets import parse_page
 
 IMAGE_DIM = 224   # required/default image dimensionality
+LOCAL_TZ = get_localzone()   # timezone for progress messages (looked up once)
 
+# Images are served from a small number of hosts, so connections are pooled and reused
+HTTP_POOL = urllib3.PoolManager(num_pools=16, maxsize=64, retries=urllib3.Retry(total=2),
+                                timeout=urllib3.Timeout(connect=3, read=10))
+
+
+def now_str():
+    """Returns the current local time, formatted for progress messages"""
+    return datetime.now(LOCAL_TZ).strftime("%b %e %H:%M")
 
 def extract_images(tweet_filepaths):
     """Extracts the images from JSONL files containing Tweets,
-    and returns a dictionary mapping from Tweet ID to image URL
-    for Tweets that have images.
+    and returns a list of (Tweet ID, image URL) pairs for Tweets
+    that have images (with one pair per Tweet ID).
     
     Arguments
     ---------
@@ -64,59 +74,101 @@ def extract_images(tweet_filepaths):
                         tweet_id, media_url = parsed_tweet[0], parsed_tweet[1]
                         if media_url is not None:
                             image_urls[tweet_id] = media_url
-    return image_urls
+    return list(image_urls.items())
+
+def shard_images(image_urls, num_shards=1, shard_id=0):
+    """Returns the (Tweet ID, image URL) pairs that belong to one of num_shards
+    disjoint shards, so that the shards can be classified in parallel (e.g. on
+    different GPUs). Image URLs are assigned to shards in turn, in order of first
+    occurrence, so Tweets with the same image are kept in the same shard.
+    
+    Arguments
+    ---------
+    image_urls: list((str, str)); list of (Tweet ID, image URL) pairs
+    num_shards: int (default 1); the number of shards to split the images into
+    shard_id: int (default 0); the index of the shard to return (from 0 to num_shards - 1)
+    """
+    if num_shards < 1 or not 0 <= shard_id < num_shards:
+        raise Exception("Invalid shard {} of {}".format(shard_id, num_shards))
+    
+    url_indices = dict()
+    return [(tweet_id, image_url) for (tweet_id, image_url) in image_urls
+            if url_indices.setdefault(image_url, len(url_indices)) % num_shards == shard_id]
 
 def load_from_url(image_url, image_size):
     """Loads an image from URL"""
     
-    res = request.urlopen(image_url).read()
-    image = Image.open(BytesIO(res)).resize(image_size)
+    response = HTTP_POOL.request("GET", image_url)
+    if response.status != 200:
+        raise Exception("Unable to load image (HTTP status {})".format(response.status))
+    image = Image.open(BytesIO(response.data))
+    # Let JPEGs be decoded at a reduced scale (no smaller than image_size), so that
+    # less has to be decoded and resized; images in other modes (e.g. RGBA or
+    # palette PNGs) are converted to RGB, so that they can still be classified
+    image.draft("RGB", image_size)
+    image = image.convert("RGB").resize(image_size, Image.BILINEAR)
     
     return image
 
 
-def load_images(image_urls, image_size, verbose=False, img_batch_size=3200, **kwargs):
+def load_image_array(image_url, image_size):
+    """Loads an image from URL as a numpy array of uint8 pixel values
+    (scaling to [0, 1] is left to classify_nd, so it is done once per batch)"""
+    required_shape = image_size + (3,)
+    image = load_from_url(image_url, image_size)
+    image = np.asarray(image, dtype=np.uint8)
+    assert image.shape == required_shape, "Image array has incorrect size: {}".format(image.shape)
+    return image
+
+
+def load_images(image_urls, image_size, verbose=False, img_batch_size=3200, download_workers=32, **kwargs):
     """Function for loading images into numpy arrays for passing to model.predict
+    Images are downloaded in parallel threads, and the next batch is downloaded
+    while the current batch is being classified.
     inputs:
-        image_urls: dict mapping from Tweet ID to image URL
+        image_urls: list of (Tweet ID, image URL) pairs
         image_size: size into which images should be resized
         verbose: show all of the image path and sizes loaded
-        img_batch_size: number of images to load at once (for best efficiency, make multiple of 32)
+        img_batch_size: number of images to load at once (for best efficiency, make multiple of 32);
+                        batches may be smaller if some images cannot be loaded
+        download_workers: number of threads to use to download images
     
     outputs: generators, split into batches:
-        loaded_images: loaded images on which keras model can run predictions
+        loaded_images: loaded images (uint8) on which keras model can run predictions
         loaded_image_identifiers: Tweet IDs and image URLs for images which the function is able to process
     """
-    required_shape = image_size + (3,)
-    loaded_images = []
-    loaded_image_paths = []
-    batch_number = 1
-
-    for tweet_id, img_url in image_urls.items():
-        try:
-            image = load_from_url(img_url, image_size)
-            image = keras.preprocessing.image.img_to_array(image)
-            assert image.shape == required_shape, "Image array has incorrect size: {}".format(image.shape)
-            image /= 255
-            if verbose:
-                print("Loaded", img_url, "size:", image_size)
+    url_items = iter(image_urls)
+    
+    def submit_batch(executor):
+        """Starts loading the next batch of images, returning their identifiers and futures"""
+        return [(tweet_id, img_url, executor.submit(load_image_array, img_url, image_size))
+                for (tweet_id, img_url) in islice(url_items, img_batch_size)]
+    
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        batch_number = 1
+        next_batch = submit_batch(executor)
+        while next_batch:
+            current_batch = next_batch
+            next_batch = submit_batch(executor)
+            
+            loaded_images = []
+            loaded_image_identifiers = []
+            for (tweet_id, img_url, future) in current_batch:
+                try:
+                    image = future.result()
+                except Exception as ex:
+                    if verbose:
+                        print("Image Load Failure: ", img_url, ex)
+                    continue
+                if verbose:
+                    print("Loaded", img_url, "size:", image_size)
+                loaded_images.append(image)
+                loaded_image_identifiers.append((tweet_id, img_url))
             
-            loaded_images.append(image)
-            loaded_image_identifiers.append((tweet_id, img_url))
-            if len(loaded_images) == img_batch_size:
+            if loaded_images:
                 yield (np.asarray(loaded_images), loaded_image_identifiers)
-                print("{}: Completed batch {}".format(datetime.now(timezone.utc).astimezone(get_localzone()).strftime("%b %e %H:%M"), batch_number))
-                loaded_images = []
-                loaded_image_identifiers = []
+                print("{}: Completed batch {}".format(now_str(), batch_number))
                 batch_number += 1
-        
-        except Exception as ex:
-            if verbose:
-                print("Image Load Failure: ", img_url, ex)
-    
-    if loaded_images:
-        yield (np.asarray(loaded_images), loaded_image_identifiers)
-        print("{}: Completed batch {}".format(datetime.now(timezone.utc).astimezone(get_localzone()).strftime("%b %e %H:%M"), batch_number))
 
 def load_model(model_path):
     if model_path is None or not os.path.exists(model_path):
@@ -127,25 +179,41 @@ def load_model(model_path):
 
 
 def classify(model, tweet_image_urls, image_dim=IMAGE_DIM, verbose=False, **kwargs):
-    """ Classify given a model, input dict mapping from tweet ID to image URL, and image dimensionality....
+    """ Classify given a model, input list of (tweet ID, image URL) pairs, and image dimensionality....
     Returns a generator that yields the output for a single image at a time, as a dictionary with keys
     tweet.id, tweet.media_url, p_drawing, p_hentai, p_neutral, p_porn, p_sexy
+    Each distinct image URL is only loaded and classified once, and its output is
+    yielded for every Tweet with that image.
     """
-    image_batches = load_images(tweet_image_urls, (image_dim, image_dim), **kwargs)
+    tweet_ids_by_url = defaultdict(list)
+    for (tweet_id, image_url) in tweet_image_urls:
+        tweet_ids_by_url[image_url].append(tweet_id)
+    unique_image_urls = [(tweet_ids[0], image_url) for (image_url, tweet_ids) in tweet_ids_by_url.items()]
+    
+    image_batches = load_images(unique_image_urls, (image_dim, image_dim), **kwargs)
     for (images, image_identifiers) in image_batches:
         probs = classify_nd(model, images, **kwargs)
-        for (image_properties, probs) in zip(image_identifiers, probs):
-            (tweet_id, image_url) = image_properties
-            row = dict(**probs)
-            row["tweet.id"] = tweet_id
-            row["image"] = image_url
-            yield row
+        for (image_properties, image_probs) in zip(image_identifiers, probs):
+            (_, image_url) = image_properties
+            for tweet_id in tweet_ids_by_url[image_url]:
+                row = dict(**image_probs)
+                row["tweet.id"] = tweet_id
+                row["image"] = image_url
+                yield row
 
 
-def classify_nd(model, nd_images, verbose=False, **kwargs):
-    """ Classify given a model, image array (numpy)...."""
+def classify_nd(model, nd_images, verbose=False, predict_batch_size=32, **kwargs):
+    """ Classify given a model, image array (numpy, uint8 pixel values)....
+    The model is called directly on sub-batches of predict_batch_size images
+    (like model.predict, but without setting up a predict loop for every batch)."""
 
-    model_preds = model.predict(nd_images, verbose=int(verbose))
+    model_preds = []
+    for start in range(0, len(nd_images), predict_batch_size):
+        # Scale pixel values to [0, 1] as a single tensor operation, so that images
+        # are passed to the device as uint8 (a quarter of the size of float32)
+        scaled_images = tf.cast(nd_images[start:start + predict_batch_size], tf.float32) / 255
+        model_preds.append(model(scaled_images, training=False).numpy())
+    model_preds = np.concatenate(model_preds)
     # preds = np.argsort(model_preds, axis = 1).tolist()
     
     categories = ['p_drawing', 'p_hentai', 'p_neutral', 'p_porn', 'p_sexy']
@@ -169,17 +237,26 @@ if __name__ == "__main__":
     parser.add_argument('--verbose', action="store_true", help="Print messages")
     parser.add_argument('--img_batch', type=int, default=3200, 
                         help="Number of images to load into memory at once")
+    parser.add_argument('--download_workers', type=int, default=32,
+                        help="Number of threads to use to download images")
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help="Number of disjoint shards to split the images into, \
+                              for classifying them in parallel (with a different --output for each)")
+    parser.add_argument('--shard_id', type=int, default=0,
+                        help="Index of the shard of images to classify (from 0 to NUM_SHARDS - 1)")
     args = parser.parse_args()
     
     image_urls = extract_images(args.tweet_filepaths)
+    image_urls = shard_images(image_urls, num_shards=args.num_shards, shard_id=args.shard_id)
     model = load_model(args.saved_model_path)
     
-    print("{}: Starting".format(datetime.now(timezone.utc).astimezone(get_localzone()).strftime("%b %e %H:%M")))
-    image_preds = classify(model, image_urls, args.image_dim, verbose=args.verbose)
+    print("{}: Starting".format(now_str()))
+    image_preds = classify(model, image_urls, args.image_dim, verbose=args.verbose,
+                           img_batch_size=args.img_batch, download_workers=args.download_workers)
     
     with open(args.out_path, "w", encoding="utf-8", newline="") as out_file:
         writer = csv.DictWriter(out_file, ["tweet.id", "image", 'p_drawing', 'p_hentai', 'p_neutral', 'p_porn', 'p_sexy'])
         writer.writeheader()
         writer.writerows(image_preds)
     
-    print("{}: Finished".format(datetime.now(timezone.utc).astimezone(get_localzone()).strftime("%b %e %H:%M")))
\ No newline at end of file
+    print("{}: Finished".format(now_str()))
\ No newline at end of file
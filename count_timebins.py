@@ -12,10 +12,35 @@ change the definition of the time bins after harvesting.
 
 import dateutil.parser
 import datetime
-import csv
 from collections import Counter
 import json
 import argparse
+import re
+import warnings
+import numpy as np
+import pandas as pd
+
+# Lengths of the sub-day units that time bins can be defined in
+UNIT_SECONDS = {"hours": 3600, "minutes": 60, "seconds": 1}
+SECONDS_PER_DAY = 86400
+NS_PER_SECOND = 10**9
+# Days between datetime.min and the Unix epoch (the origin of datetime64 values)
+EPOCH_DAYS = datetime.datetime(1970, 1, 1).toordinal() - 1
+UTC_OFFSET_RE = re.compile(r"[T ][\d:.,]*(Z|[+-]\d\d(?::?\d\d(?::?\d\d(?:\.\d+)?)?)?)$")
+
+def parse_time(time_str):
+    """Parses an ISO format timestamp into a datetime object. Uses the fast
+    built-in parser where possible, falling back on dateutil for timestamps
+    it does not accept (e.g. a trailing Z before Python 3.11).
+    
+    Arguments
+    ---------
+    time_str: str; the ISO format timestamp to parse
+    """
+    try:
+        return datetime.datetime.fromisoformat(time_str)
+    except ValueError:
+        return dateutil.parser.isoparse(time_str)
 
 def floor_time(dt, to=1, unit="days"):
     """Floors a datetime object by rounding it down to a multiple of a
@@ -68,6 +93,113 @@ def bin_time(dt, interval=1, unit="days"):
     upper_limit = lower_limit + datetime.timedelta(**{unit: interval})
     return "{}_{}".format(lower_limit.isoformat(), upper_limit.isoformat())
 
+def get_bin_key(dt, interval=1, unit="days"):
+    """Returns a key that is shared by all datetime objects in the same bin
+    (with the same timezone), and so by all datetime objects that bin_time()
+    gives the same result for. Bins are counted in the same way as floor_time().
+    
+    Arguments
+    ---------
+    dt: datetime.datetime; the time to bin
+    interval: int (default 1); the bin interval size (without units)
+    unit: str (default "days"); the unit of the bin interval
+              (valid options: "days", "hours", "minutes", "seconds")
+    """
+    days = dt.toordinal() - 1
+    if unit == "days":
+        return (days // interval, None, dt.tzinfo)
+    seconds = dt.hour * 3600 + dt.minute * 60 + dt.second
+    return (days, seconds // (UNIT_SECONDS[unit] * interval), dt.tzinfo)
+
+def count_time_bins(time_strs, interval=1, unit="days"):
+    """Bins timestamps one at a time and returns a dictionary (Counter) counting
+    how many occur in each bin. Bin strings are only formatted once per bin.
+    
+    Arguments
+    ---------
+    time_strs: iter of str; the ISO format timestamps to bin
+    interval: int (default 1); the bin interval size (without units)
+    unit: str (default "days"); the unit of the bin interval
+              (valid options: "days", "hours", "minutes", "seconds")
+    """
+    bin_strs = dict()
+    counter = Counter()
+    for time_str in time_strs:
+        time_parsed = parse_time(time_str)
+        bin_key = get_bin_key(time_parsed, interval=interval, unit=unit)
+        time_bin = bin_strs.get(bin_key)
+        if time_bin is None:
+            time_bin = bin_time(time_parsed, interval=interval, unit=unit)
+            bin_strs[bin_key] = time_bin
+        counter[time_bin] += 1
+    return counter
+
+def parse_wall_times(time_strs):
+    """Parses a non-empty column of ISO format timestamps with pandas, and returns
+    their local wall-clock times as a (naive) datetime64 column. Returns None if
+    the timestamps cannot be handled as a single datetime64 column (e.g. they are
+    missing, out of range, or have mixed UTC offsets).
+    
+    Arguments
+    ---------
+    time_strs: pd.Series of str; the ISO format timestamps to parse
+    """
+    # A UTC offset shared by every timestamp can be cut off before parsing
+    # (pandas parses naive timestamps far faster than offset-aware ones)
+    offset = UTC_OFFSET_RE.search(time_strs.iat[0])
+    if offset is not None:
+        offset = offset.group(1)
+        if not time_strs.str.endswith(offset).all():
+            return None
+        time_strs = time_strs.str.slice(0, -len(offset))
+    try:
+        with warnings.catch_warnings():
+            # Mixed naive and aware timestamps are rejected below
+            warnings.simplefilter("ignore", FutureWarning)
+            times = pd.to_datetime(time_strs, format="ISO8601")
+    except (ValueError, OverflowError):
+        return None
+    if not pd.api.types.is_datetime64_dtype(times) or times.isna().any():
+        return None
+    return times
+
+def count_time_bins_vectorized(time_strs, interval=1, unit="days"):
+    """Bins timestamps all at once with pandas/numpy and returns a dictionary
+    (Counter) counting how many occur in each bin, in order of first occurrence.
+    Returns None if the timestamps cannot be handled as a single datetime64
+    column (e.g. they are missing, out of range, or have mixed UTC offsets).
+    
+    Arguments
+    ---------
+    time_strs: pd.Series of str; the ISO format timestamps to bin
+    interval: int (default 1); the bin interval size (without units)
+    unit: str (default "days"); the unit of the bin interval
+              (valid options: "days", "hours", "minutes", "seconds")
+    """
+    if len(time_strs) == 0:
+        return Counter()
+    # Bins are defined on local wall-clock time, as in floor_time()
+    times = parse_wall_times(time_strs)
+    if times is None:
+        return None
+    
+    seconds = times.to_numpy(dtype="datetime64[ns]").view("i8") // NS_PER_SECOND
+    days = seconds // SECONDS_PER_DAY + EPOCH_DAYS
+    if unit == "days":
+        bin_keys = days // interval
+    else:
+        bin_seconds = UNIT_SECONDS[unit] * interval
+        bin_keys = days * SECONDS_PER_DAY + seconds % SECONDS_PER_DAY // bin_seconds * bin_seconds
+    
+    # Format each bin from the first timestamp that falls into it
+    _, first_indices, counts = np.unique(bin_keys, return_index=True, return_counts=True)
+    order = np.argsort(first_indices)
+    counter = Counter()
+    for first_index, count in zip(first_indices[order].tolist(), counts[order].tolist()):
+        time_parsed = parse_time(time_strs.iat[first_index])
+        counter[bin_time(time_parsed, interval=interval, unit=unit)] += count
+    return counter
+
 def bin_tweets_by_time(in_path, column_name="tweet.created_at", interval=1, unit="days"):
     """Bins tweets into time intervals and returns a dictionary counting
     how many tweets occur in a given interval.
@@ -80,14 +212,16 @@ def bin_tweets_by_time(in_path, column_name="tweet.created_at", interval=1, unit
     unit: str (default "days"); the unit of the bin interval
               (valid options: "days", "hours", "minutes", "seconds")
     """
-    counter = Counter()
-    with open(in_path, encoding="utf-8") as in_file:
-        reader = csv.DictReader(in_file)
-        for row in reader:
-            time_str = row[column_name]
-            time_parsed = dateutil.parser.isoparse(time_str)
-            time_bin = bin_time(time_parsed, interval=interval, unit=unit)
-            counter[time_bin] += 1
+    if interval < 1 or not isinstance(interval, int):
+        raise Exception("Invalid interval parameter: {}".format(interval))
+    if unit != "days" and unit not in UNIT_SECONDS:
+        raise Exception("Unknown unit: {}".format(unit))
+    
+    time_strs = pd.read_csv(in_path, usecols=[column_name], dtype=str,
+                            keep_default_na=False, encoding="utf-8")[column_name]
+    counter = count_time_bins_vectorized(time_strs, interval=interval, unit=unit)
+    if counter is None:
+        counter = count_time_bins(time_strs, interval=interval, unit=unit)
     return counter
 
 def dump_counts(counter, out_path):
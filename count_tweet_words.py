@@ -15,38 +15,166 @@ import csv
 import emoji
 import argparse
 import re
+import functools
+from collections import Counter
+from itertools import islice
+from parallel_io import IO_BUFFER_SIZE, map_in_processes
+
+# Number of distinct words whose normalized forms are cached
+NORMALIZE_CACHE_SIZE = 1 << 18
+# Number of tweets sent to a worker process at a time
+TWEETS_PER_CHUNK = 5000
+
+def make_trie(strings):
+    """Returns a trie (nested dictionaries, keyed by character) of the provided
+    strings. The end of each string is marked by an empty string key.
+    """
+    trie = dict()
+    for string in strings:
+        node = trie
+        for char in string:
+            node = node.setdefault(char, dict())
+        node[""] = True
+    return trie
+
+def trie_to_pattern(trie):
+    """Converts a trie from make_trie() into a regex pattern that matches the
+    longest of its strings starting at a given position.
+    """
+    ends = list()
+    branches = list()
+    for char, node in sorted(trie.items()):
+        if not char:
+            continue
+        elif list(node) == [""]:
+            ends.append(re.escape(char))
+        else:
+            branches.append(re.escape(char) + trie_to_pattern(node))
+    if len(ends) > 1:
+        branches.append("[" + "".join(ends) + "]")
+    else:
+        branches.extend(ends)
+    pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    if "" in trie:
+        pattern = "(?:" + pattern + ")?"
+    return pattern
+
+def chars_to_class(chars, max_gap=16):
+    """Returns a regex character class that matches all of the provided characters.
+    For brevity (and so faster matching), non-ASCII characters that are at most
+    max_gap code points apart are joined into ranges, so the class can also match
+    some characters in between them.
+    """
+    ranges = list()
+    for code in sorted(set(map(ord, chars))):
+        if ranges and code > 127 and code - ranges[-1][1] <= max_gap:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    return "[" + "".join(re.escape(chr(first)) if first == last else
+                         "{}-{}".format(re.escape(chr(first)), re.escape(chr(last)))
+                         for (first, last) in ranges) + "]"
+
+# Pattern matching every emoji, preferring the longest match (as emoji does).
+# The lookahead quickly rules out characters that cannot start an emoji.
+EMOJI_RE = re.compile("(?={}){}".format(chars_to_class(chars[0] for chars in emoji.EMOJI_DATA),
+                                       trie_to_pattern(make_trie(emoji.EMOJI_DATA))))
+# Characters that emoji.replace_emoji treats specially outside of an emoji
+# (joiners between emoji are dropped, as are stray variation selectors)
+EMOJI_SPECIAL_RE = re.compile("[\u200d\ufe0e\ufe0f]")
+# Characters that can follow each emoji as part of a longer one
+EMOJI_EXTENSIONS = dict()
+for emoji_chars in emoji.EMOJI_DATA:
+    for i in range(1, len(emoji_chars)):
+        EMOJI_EXTENSIONS.setdefault(emoji_chars[:i], set()).add(emoji_chars[i])
+
+def replace_emoji(string, replace):
+    """Replaces all emoji in a provided string, giving the same result as
+    emoji.replace_emoji() but matching emoji with a single compiled regex.
+    Strings where the results could differ (because emoji are joined into
+    sequences emoji does not know, or are followed by part of a longer emoji)
+    are passed on to emoji.replace_emoji().
+    
+    Arguments
+    ---------
+    string: str; the string to replace emoji in
+    replace: str or function; the replacement for each emoji, or a function from
+                 the emoji to its replacement
+    """
+    pieces = list()
+    last_end = 0
+    for match in EMOJI_RE.finditer(string):
+        start, end = match.span()
+        chars = match.group()
+        if (EMOJI_SPECIAL_RE.search(string, last_end, start) or
+            string[end:end + 1] in EMOJI_EXTENSIONS.get(chars, ())):
+            break
+        pieces.append(string[last_end:start])
+        pieces.append(replace if isinstance(replace, str) else replace(chars))
+        last_end = end
+    else:
+        if not EMOJI_SPECIAL_RE.search(string, last_end):
+            if not pieces:
+                return string
+            pieces.append(string[last_end:])
+            return "".join(pieces)
+    if not isinstance(replace, str):
+        return emoji.replace_emoji(string, replace=lambda chars, data_dict: replace(chars))
+    return emoji.replace_emoji(string, replace=replace)
+
+# Patterns used to normalize punctuation and split words
+ELLIPSIS_RE = re.compile(r"\.{2,}")
+EXCLAMATION_RE = re.compile(r"!(?:1?!)*")
+CONTRACTION_RE = re.compile(r"’(s|d|ll|re|ve|m|all)")
+HASHES_RE = re.compile(r"#+")
+WHITESPACE_RE = re.compile(r"\s+")
+SUBWORD_SEPARATOR_RE = re.compile(r"[/?]")
+# Characters stripped from the edges of words by normalize(): from both edges,
+# then from the right edge only (so left-aligned @ and # are kept), then from
+# the left edge of words starting with < (other than <3)
+EDGE_PUNCTUATION = ",.?/[]\\{}|=+-–—_()*^!~`>‘’'\"“”…•&"
+RIGHT_EDGE_PUNCTUATION = "@#<:;"
+LEFT_ARROW_PUNCTUATION = ",.?/[]\\{}|=+-—_()*^!~`<>:;‘’'\"“”…•&"
 
 def space_out_emoji(string):
     """Inserts whitespace around all emoji in a provided string."""
-    return emoji.replace_emoji(string, replace=lambda chars, data_dict: " " + chars + " ")
+    return replace_emoji(string, replace=lambda chars: " " + chars + " ")
 
 def space_out_punctuation(string):
-    """Inserts whitespace around punctuation in a provided string."""
-    string = string.replace("&amp;", " & ")
-    string = string.replace("&lt;", " <")
-    string = string.replace("&gt;", " >")
+    """Inserts whitespace around punctuation in a provided string.
+    Groups of replacements that all involve a particular character are skipped
+    when the string does not contain that character.
+    """
+    if "&" in string:
+        string = string.replace("&amp;", " & ")
+        string = string.replace("&lt;", " <")
+        string = string.replace("&gt;", " >")
     string = string.replace(",", ", ")
     string = string.replace("…", "… ")
-    string = re.sub(r"\.{2,}", ". ", string)
-    string = string.replace("b!tch", "b*tch")
-    string = string.replace("sh!t", "sh*t")
-    string = re.sub(r"!(?:1?!)*", "! ", string)
+    if ".." in string:
+        string = ELLIPSIS_RE.sub(". ", string)
+    if "!" in string:
+        string = string.replace("b!tch", "b*tch")
+        string = string.replace("sh!t", "sh*t")
+        string = EXCLAMATION_RE.sub("! ", string)
     string = string.replace("•", " •")
     string = string.replace("‘", " '")
-    string = string.replace("n’t", "n't")
-    string = re.sub(r"’(s|d|ll|re|ve|m|all)", r"'\1", string)
-    string = string.replace("’", "' ")
+    if "’" in string:
+        string = string.replace("n’t", "n't")
+        string = CONTRACTION_RE.sub(r"'\1", string)
+        string = string.replace("’", "' ")
     string = string.replace("“", "\"")
     string = string.replace("”", "\"")
     string = string.replace("\"", " \" ")
     string = string.replace("http", " http")
-    string = re.sub(r"#+", " #", string)
-    string = re.sub(r"\s+", " ", string)
+    if "#" in string:
+        string = HASHES_RE.sub(" #", string)
+    string = WHITESPACE_RE.sub(" ", string)
     return string
 
 def remove_emoji(string):
     """Removes all emoji from a provided string."""
-    return emoji.replace_emoji(string, replace=" ")
+    return replace_emoji(string, replace=" ")
         
 def normalize(word, emoji_to_text=False, remove_links=True):
     """Normalizes a provided word by lowercasing and stripping edge
@@ -55,18 +183,29 @@ def normalize(word, emoji_to_text=False, remove_links=True):
     If remove_links is True, removes links from Tweet text.
     """
     word = word.lower()
-    word = word.strip(",.?/[]\\{}|=+-–—_()*^!~`>‘’'\"“”…•&")
-    word = word.rstrip("@#<:;")
+    word = word.strip(EDGE_PUNCTUATION)
+    word = word.rstrip(RIGHT_EDGE_PUNCTUATION)
     if remove_links and word.startswith("http") or word.startswith("www"):
         word = word.replace(word, "")
     if word.startswith("<") and word != "<3":
-        word = word.lstrip(",.?/[]\\{}|=+-—_()*^!~`<>:;‘’'\"“”…•&")
+        word = word.lstrip(LEFT_ARROW_PUNCTUATION)
     if emoji_to_text and emoji.is_emoji(word):
         word = emoji.EMOJI_DATA[word]["en"]
     if ("/" in word or "?" in word) and not (word.startswith("http") or word.startswith("www") or "." in word):
-        word = [normalize(subword) for subword in re.split(r"[/?]", word)]
+        word = [normalize(subword) for subword in SUBWORD_SEPARATOR_RE.split(word)]
     return(word)
     
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_to_words(word, emoji_to_text=False, remove_links=True):
+    """Normalizes a provided word with normalize() and returns a tuple of the
+    resulting non-empty words. Results are cached, since the same words recur
+    across many tweets.
+    """
+    word = normalize(word, emoji_to_text=emoji_to_text, remove_links=remove_links)
+    if isinstance(word, list):
+        return tuple(subword for subword in word if subword)
+    return (word,) if word else ()
+    
 def extract_words(string, include_emoji=True, emoji_to_text=False,
                  remove_links=True):
     """Extracts a list of normalized words from a provided string.
@@ -83,14 +222,7 @@ def extract_words(string, include_emoji=True, emoji_to_text=False,
     
     words = list()
     for word in string.split():
-        word = normalize(word, emoji_to_text=emoji_to_text,
-                        remove_links=remove_links)
-        if isinstance(word, list):
-            for subword in word:
-                if subword:
-                    words.append(subword)
-        elif word:
-            words.append(word)
+        words.extend(normalize_to_words(word, emoji_to_text, remove_links))
             
     return words
 
@@ -98,20 +230,34 @@ def get_tweets(in_path, column_name="tweet.text"):
     """Reads a processed tweet CSV and yields a generator over rows in the
     tweet column, with a provided column_name.
     """
-    with open(in_path, encoding="utf-8") as in_file:
-        reader = csv.DictReader(in_file)
+    with open(in_path, encoding="utf-8", buffering=IO_BUFFER_SIZE) as in_file:
+        reader = csv.reader(in_file)
+        header = next(reader)
+        # Like csv.DictReader, take the last column with the name and skip blank rows
+        column_index = len(header) - 1 - header[::-1].index(column_name)
         for row in reader:
-            yield row[column_name]
+            if row:
+                yield row[column_index]
 
 def count_words_in_tweets(tweets, **kwargs):
-    """Returns a dictionary counting how often each word occurs in an iter
+    """Returns a dictionary (Counter) counting how often each word occurs in an iter
     of tweets (strings).
     """
-    counter = dict()
+    counter = Counter()
     for tweet in tweets:
-        words = extract_words(tweet, **kwargs)
-        for word in words:
-            counter[word] = counter.get(word, 0) + 1
+        counter.update(extract_words(tweet, **kwargs))
+    return counter
+
+def count_words_in_tweets_in_parallel(tweets, workers=2, **kwargs):
+    """Returns a dictionary (Counter) counting how often each word occurs in an iter
+    of tweets (strings), counting chunks of tweets in several processes at once.
+    Keyword arguments are passed on to extract_words().
+    """
+    counter = Counter()
+    tweets = iter(tweets)
+    chunks = iter(lambda: list(islice(tweets, TWEETS_PER_CHUNK)), [])
+    for chunk_counter in map_in_processes(count_words_in_tweets, chunks, workers=workers, **kwargs):
+        counter.update(chunk_counter)
     return counter
 
 def dump_counts(counter, out_path, sort_by_count=True):
@@ -139,9 +285,14 @@ if __name__=="__main__":
     parser.add_argument("--text-emoji", dest="emoji_to_text", action="store_true", help="Convert emoji to text")
     parser.add_argument("--sort-alpha", dest="sort_by_count", action="store_false", help="Sort words alphabetically (not by count)")
     parser.add_argument("--keep-links", dest="remove_links", action="store_false", help="Keep links in the Tweet text")
+    parser.add_argument("--workers", default=1, type=int, help="Number of processes to count words in")
     args = parser.parse_args()
     
     tweets = get_tweets(args.in_path, column_name=args.tweet_column)
-    counter = count_words_in_tweets(tweets, include_emoji=args.include_emoji, emoji_to_text=args.emoji_to_text,
-                                   remove_links=args.remove_links)
+    if args.workers > 1:
+        counter = count_words_in_tweets_in_parallel(tweets, workers=args.workers, include_emoji=args.include_emoji,
+                                                    emoji_to_text=args.emoji_to_text, remove_links=args.remove_links)
+    else:
+        counter = count_words_in_tweets(tweets, include_emoji=args.include_emoji, emoji_to_text=args.emoji_to_text,
+                                       remove_links=args.remove_links)
     dump_counts(counter, args.out_path, sort_by_count=args.sort_by_count)
@@ -16,8 +16,82 @@ Tweet to CSV (since CSV format is not designed for nested cells).
 import json
 import csv
 import argparse
+import functools
+import io
+import mmap
+import os
+from itertools import islice
+from parallel_io import IO_BUFFER_SIZE, map_in_processes
 
-def jsonl_to_csv(in_path, out_path, fields=None, renamings=None):
+# Kinds of field, used to decide where each field's value comes from
+USER_FIELD = 0
+PLACE_FIELD = 1
+MEDIA_FIELD = 2
+REPLY_FIELD = 3
+REPLY_TYPE_FIELD = 4
+CONTAINS_URL_FIELD = 5
+EXPANDED_URL_FIELD = 6
+TWEET_FIELD = 7
+
+# Prefixes of fields that are looked up in the includes of a results page
+LOOKUP_PREFIXES = ("user.", "tweet.place_", "tweet.media_", "reply.")
+
+# Shared (read-only) entry for Tweets with no user, place, reply or media information
+EMPTY_ENTRY = dict()
+
+# Use orjson to parse results pages if it is available, since it is much faster
+try:
+    import orjson
+    parse_json = orjson.loads
+except ImportError:
+    parse_json = json.loads
+
+# Default fields to extract
+# (fields that are about the tweet start with tweet.,
+# fields that are about the user start with user.,
+# fields that are about the place from which the tweet was posted start with tweet.place_,
+# fields that are about the tweet to which this tweet is a reply start with reply.,
+# fields that are about the FIRST media item in the tweet start with tweet.media_)
+DEFAULT_FIELDS = [
+    "tweet.id",
+    "tweet.text",
+    "tweet.created_at",
+    "tweet.lang",
+    "tweet.retweet_count",
+    "tweet.reply_count",
+    "tweet.like_count",
+    "tweet.quote_count",
+    "tweet.place_id",
+    "tweet.place_type",
+    "tweet.place_full_name",
+    "tweet.media_key",
+    "tweet.media_type",
+    "tweet.media_url",
+    "tweet.media_alt_text",
+    "tweet.media_view_count",
+    "tweet.contains_url",
+    "tweet.reply_type",
+    "reply.id",
+    "reply.text",
+    "reply.author_id",
+    "user.id",
+    "user.username",
+    "user.name",
+    "user.location",
+    "user.description",
+    "user.created_at",
+    "user.followers_count",
+    "user.following_count",
+    "user.tweet_count"
+]
+
+# Number of rows to pass to the CSV writer at once
+WRITE_BATCH_SIZE = 1024
+
+# Number of results pages (JSONL lines) to send to a worker process at once
+PAGES_PER_CHUNK = 50
+
+def jsonl_to_csv(in_path, out_path, fields=None, renamings=None, workers=1):
     """Converts a provided .jsonl of tweets to a CSV file at a provided path,
     extracting the designated fields.
     
@@ -26,9 +100,41 @@ def jsonl_to_csv(in_path, out_path, fields=None, renamings=None):
     in_path: str; path to the input .jsonl (or .json) file
     out_path: str; path to the output .csv file
     fields: list(str); list of field names to extract
+    renamings: dict(str, str); dictionary mapping from field names to column headings,
+               to rename the extracted fields
+    workers: int; number of processes to use to extract fields (if more than 1,
+             chunks of pages are converted in parallel and written in order)
     """
-    with open(in_path, encoding="utf-8") as in_file:
-        convert_to_csv(in_file, out_path, fields=fields, renamings=renamings)
+    # Read in binary mode, so lines can be parsed without decoding them first
+    with open(in_path, "rb") as in_file:
+        lines = read_lines(in_file)
+        if workers > 1:
+            convert_to_csv_in_parallel(lines, out_path, fields=fields, renamings=renamings,
+                                       workers=workers)
+        else:
+            convert_to_csv(lines, out_path, fields=fields, renamings=renamings)
+
+
+def read_lines(in_file):
+    """Yields the lines of a file opened in binary mode (without line breaks),
+    by memory-mapping the file and scanning it for newlines.
+    
+    Arguments
+    ---------
+    in_file: file; an open file, in binary mode
+    """
+    # Empty files cannot be memory-mapped
+    if os.fstat(in_file.fileno()).st_size == 0:
+        return
+    with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+        start = 0
+        end = mapped_file.find(b"\n")
+        while end != -1:
+            yield mapped_file[start:end]
+            start = end + 1
+            end = mapped_file.find(b"\n", start)
+        if start < len(mapped_file):
+            yield mapped_file[start:]
 
         
 def convert_to_csv(results_iter, out_path, fields=None, renamings=None):
@@ -38,80 +144,150 @@ def convert_to_csv(results_iter, out_path, fields=None, renamings=None):
     Arguments
     ---------
     results_iter: iter(dict); iterator over tweet search results pages, each formatted
-                  as a dict
+                  as a dict (or as a line of JSON, in str or bytes)
     out_path: str; path to the output .csv file
     fields: list(str); list of field names to extract
     renamings: dict(str, str); dictionary mapping from field names to column headings,
-               to rename the extracted fields
+               to rename the extracted fields (only the header row is affected,
+               since rows are lists in the same order as fields)
     """
-    # Fill in default values of fields
-    # Fields that are about the tweet start with tweet.,
-    # fields that are about the user start with user.,
-    # fields that are about the place from which the tweet was posted start with tweet.place_,
-    # fields that are about the tweet to which this tweet is a reply start with reply.,
-    # fields that are about the FIRST media item in the tweet start with tweet.media_,
     if fields is None:
-        fields = [
-        "tweet.id",
-        "tweet.text",
-        "tweet.created_at",
-        "tweet.lang",
-        "tweet.retweet_count",
-        "tweet.reply_count",
-        "tweet.like_count",
-        "tweet.quote_count",
-        "tweet.place_id",
-        "tweet.place_type",
-        "tweet.place_full_name",
-        "tweet.media_key",
-        "tweet.media_type",
-        "tweet.media_url",
-        "tweet.media_alt_text",
-        "tweet.media_view_count",
-        "tweet.contains_url",
-        "tweet.reply_type",
-        "reply.id",
-        "reply.text",
-        "reply.author_id",
-        "user.id",
-        "user.username",
-        "user.name",
-        "user.location",
-        "user.description",
-        "user.created_at",
-        "user.followers_count",
-        "user.following_count",
-        "user.tweet_count"
-        ]
+        fields = DEFAULT_FIELDS
            
-    with open(out_path, "w", encoding="utf-8", newline='') as out_file:
+    with open(out_path, "w", encoding="utf-8", newline='', buffering=IO_BUFFER_SIZE) as out_file:
         writer = csv.writer(out_file)
-        if renamings is None:
-            writer.writerow(fields)
-        else:
-            renamed_fields = [renamings.get(field, field) for field in fields]
-            writer.writerow(renamed_fields)
+        write_header(writer, fields, renamings)
+        compiled_fields = compile_fields(fields)
+        relevant_fields = get_relevant_fields(fields)
+        batch = list()
         for results_page in results_iter:
-            if isinstance(results_page, str):
-                results_page = json.loads(results_page.strip())
-            for row in parse_page(results_page, fields):
-                if renamings is not None:
-                    row = rename_fields(row, renamings)
-                writer.writerow(row)
+            if isinstance(results_page, (str, bytes)):
+                results_page = parse_json(results_page)
+            for row in parse_page(results_page, fields, compiled_fields, relevant_fields):
+                batch.append(row)
+                if len(batch) >= WRITE_BATCH_SIZE:
+                    writer.writerows(batch)
+                    batch = list()
+        if batch:
+            writer.writerows(batch)
+
+
+def convert_to_csv_in_parallel(results_lines, out_path, fields=None, renamings=None, workers=2):
+    """Converts the lines of a JSONL file of search results to a CSV file at a provided
+    path, extracting the designated fields in several processes at once.
+    
+    Arguments
+    ---------
+    results_lines: iter(bytes); iterator over lines of JSONL, with one results page
+                   per line
+    out_path: str; path to the output .csv file
+    fields: list(str); list of field names to extract
+    renamings: dict(str, str); dictionary mapping from field names to column headings,
+               to rename the extracted fields
+    workers: int; number of worker processes
+    """
+    if fields is None:
+        fields = DEFAULT_FIELDS
+    
+    with open(out_path, "w", encoding="utf-8", newline='', buffering=IO_BUFFER_SIZE) as out_file:
+        write_header(csv.writer(out_file), fields, renamings)
+        
+        chunks = iter(lambda: list(islice(results_lines, PAGES_PER_CHUNK)), [])
+        for csv_text in map_in_processes(convert_chunk, chunks, workers=workers, fields=fields):
+            out_file.write(csv_text)
+
+
+def convert_chunk(lines, fields):
+    """Converts a chunk of JSONL lines to CSV text (without a header), so that
+    only a single string has to be passed back from a worker process.
+    
+    Arguments
+    ---------
+    lines: list(bytes); lines of JSON, each containing a results page
+    fields: list(str); list of field names to extract
+    
+    Returns
+    -------
+    csv_text: str; the extracted rows, formatted as CSV
+    """
+    compiled_fields = compile_fields(fields)
+    relevant_fields = get_relevant_fields(fields)
+    out_text = io.StringIO()
+    writer = csv.writer(out_text)
+    for line in lines:
+        writer.writerows(parse_page(parse_json(line), fields, compiled_fields, relevant_fields))
+    return out_text.getvalue()
+
+
+def write_header(writer, fields, renamings=None):
+    """Writes the header row of a CSV file, renaming fields if required.
+    
+    Arguments
+    ---------
+    writer: a csv.writer for the output file
+    fields: list(str); list of field names to extract
+    renamings: dict(str, str); dictionary mapping from field names to column headings
+    """
+    if renamings is None:
+        writer.writerow(fields)
+    else:
+        writer.writerow([renamings.get(field, field) for field in fields])
+
 
+def compile_fields(fields):
+    """Works out where the value of each field comes from, so that this only
+    has to be done once rather than for every Tweet.
+    
+    Arguments
+    ---------
+    fields: list(str); list of field names to extract
+    
+    Returns
+    -------
+    compiled_fields: list((int, str)); for each field, in order, the kind of field
+                     (e.g. USER_FIELD) and the key to look it up by
+    """
+    compiled_fields = list()
+    for field in fields:
+        if field.startswith("user."):
+            compiled_fields.append((USER_FIELD, field))
+        elif field.startswith("tweet.place_"):
+            compiled_fields.append((PLACE_FIELD, field))
+        elif field.startswith("tweet.media_"):
+            compiled_fields.append((MEDIA_FIELD, field))
+        elif field.startswith("reply."):
+            compiled_fields.append((REPLY_FIELD, field))
+        elif field == "tweet.reply_type":
+            compiled_fields.append((REPLY_TYPE_FIELD, field))
+        elif field == "tweet.contains_url":
+            compiled_fields.append((CONTAINS_URL_FIELD, field))
+        elif field == "tweet.expanded_url":
+            compiled_fields.append((EXPANDED_URL_FIELD, field))
+        elif field.startswith("tweet."):
+            compiled_fields.append((TWEET_FIELD, field[6:]))
+        else:
+            raise Exception('Unrecognized field: {}'.format(field))
+    return compiled_fields
 
-def rename_fields(row, renamings):
-    """Rename the keys of a dictionary.
+
+def get_relevant_fields(fields):
+    """Finds the fields that are relevant to each kind of entry in the includes
+    of a results page, with their prefixes removed.
     
     Arguments
     ---------
-    row: dict; the dictionary whose keys are to be renamed.
-    renamings: dict(str, str); a map from old names to new names.
+    fields: list(str); list of field names to extract
+    
+    Returns
+    -------
+    relevant_fields: dict(str, frozenset(str)); a dictionary that maps from each
+                     prefix in LOOKUP_PREFIXES to the relevant fields for that prefix
     """
-    return dict((renamings.get(key, key), value) for (key, value) in row)
+    return {prefix: frozenset(field[len(prefix):] for field in fields if field.startswith(prefix))
+            for prefix in LOOKUP_PREFIXES}
 
 
-def parse_page(page, fields):
+def parse_page(page, fields, compiled_fields=None, relevant_fields=None):
     """Parse a page of results by extracting the required fields, and yields
     rows to be written to CSV, one at a time.
     
@@ -119,31 +295,50 @@ def parse_page(page, fields):
     ---------
     page: a JSON output of the Twitter API v2
     fields: list(str); list of field names to extract
+    compiled_fields: list((int, str)); the output of compile_fields(fields), which
+                     is computed if not provided
+    relevant_fields: dict(str, frozenset(str)); the output of get_relevant_fields(fields),
+                     which is computed if not provided
     
     Yields
     ------
     row: list(str); a row to be written to CSV, where fields are in the order
          given in fields
     """    
-    # Extract reverse lookups
-    user_lookup = make_reverse_lookup(page["includes"]["users"], "user.", fields)
+    if relevant_fields is None:
+        relevant_fields = get_relevant_fields(fields)
+    
+    # Extract reverse lookups (only for the kinds of entry that have requested fields)
+    user_lookup = dict()
+    if relevant_fields["user."]:
+        user_lookup = make_reverse_lookup(page["includes"]["users"], "user.", fields,
+                                          relevant_fields["user."])
     place_lookup = dict()
-    if "places" in page["includes"]:
-        place_lookup = make_reverse_lookup(page["includes"]["places"], "tweet.place_", fields)
+    if relevant_fields["tweet.place_"] and "places" in page["includes"]:
+        place_lookup = make_reverse_lookup(page["includes"]["places"], "tweet.place_", fields,
+                                           relevant_fields["tweet.place_"])
     reply_lookup = dict()
-    if "tweets" in page["includes"]:
-        reply_lookup = make_reverse_lookup(page["includes"]["tweets"], "reply.", fields)
+    if relevant_fields["reply."] and "tweets" in page["includes"]:
+        reply_lookup = make_reverse_lookup(page["includes"]["tweets"], "reply.", fields,
+                                           relevant_fields["reply."])
     media_lookup = dict()
-    if "media" in page["includes"]:
-        media_lookup = make_reverse_lookup(page["includes"]["media"], "tweet.media_", fields)
+    if relevant_fields["tweet.media_"] and "media" in page["includes"]:
+        media_lookup = make_reverse_lookup(page["includes"]["media"], "tweet.media_", fields,
+                                           relevant_fields["tweet.media_"])
+    
+    if compiled_fields is None:
+        compiled_fields = compile_fields(fields)
+    used_kinds = frozenset(kind for (kind, key) in compiled_fields)
+    build_row = make_row_builder(tuple(compiled_fields))
     
-    rows = list()
     for tweet in page["data"]:
-        row = extract_fields(tweet, fields, user_lookup, place_lookup, reply_lookup, media_lookup)
+        row = extract_fields(tweet, fields, user_lookup, place_lookup, reply_lookup, media_lookup,
+                             compiled_fields, used_kinds, build_row)
         yield row
 
 
-def extract_fields(tweet, fields, user_lookup, place_lookup, reply_lookup, media_lookup):
+def extract_fields(tweet, fields, user_lookup, place_lookup, reply_lookup, media_lookup,
+                   compiled_fields=None, used_kinds=None, build_row=None):
     """Extracts the required fields from a single tweet and returns a row to
     be written to CSV.
     
@@ -160,74 +355,104 @@ def extract_fields(tweet, fields, user_lookup, place_lookup, reply_lookup, media
                   to all the fields that are relevant for that reply
     media_lookup: dict(str, dict(str, str)); a dictionary that maps from media keys
                   to all the fields that are relevant for that media
+    compiled_fields: list((int, str)); the output of compile_fields(fields), which
+                     is computed if not provided
+    used_kinds: frozenset(int); the kinds of field in compiled_fields, so that
+                information that is not required can be skipped
+    build_row: function; the output of make_row_builder(tuple(compiled_fields)), which
+               is looked up if not provided
     
     Returns
     -------
     row: list(str); a row to be written to CSV, where fields are in the order
          given in fields
     """
+    if compiled_fields is None:
+        compiled_fields = compile_fields(fields)
+    if used_kinds is None:
+        used_kinds = frozenset(kind for (kind, key) in compiled_fields)
+    if build_row is None:
+        build_row = make_row_builder(tuple(compiled_fields))
+    
     # Prepick the user and place dictionaries
-    user_info = user_lookup[tweet["author_id"]]
-    place_info = dict()
-    try:
-        place_info = place_lookup[tweet["geo"]["place_id"]]
-    except KeyError:
-        pass
+    user_info = EMPTY_ENTRY
+    if USER_FIELD in used_kinds:
+        user_info = user_lookup.get(tweet["author_id"], EMPTY_ENTRY)
+    place_info = EMPTY_ENTRY
+    if PLACE_FIELD in used_kinds:
+        geo = tweet.get("geo")
+        if geo is not None and "place_id" in geo:
+            place_info = place_lookup.get(geo["place_id"], EMPTY_ENTRY)
     
     # Special check for whether this is a reply,
     # and load reply dictionary if so
     reply_type = None
-    reply_info = {field: None for field in fields if field.startswith("reply.")}
-    if "referenced_tweets" in tweet:
-        reply_type = tweet["referenced_tweets"][0]["type"]
-        try:
-            reply_info = reply_lookup[tweet["referenced_tweets"][0]["id"]]
-        except KeyError:
-            pass
+    reply_info = EMPTY_ENTRY
+    if "referenced_tweets" in tweet and (REPLY_TYPE_FIELD in used_kinds or REPLY_FIELD in used_kinds):
+        referenced_tweet = tweet["referenced_tweets"][0]
+        reply_type = referenced_tweet["type"]
+        reply_info = reply_lookup.get(referenced_tweet["id"], EMPTY_ENTRY)
         
     # Check for whether there are media, and load media dictionary if so
-    media_info = {field: None for field in fields if field.startswith("tweet.media_")}
-    if "attachments" in tweet and "media_keys" in tweet["attachments"]:
-        media_info = media_lookup[tweet["attachments"]["media_keys"][0]]
+    media_info = EMPTY_ENTRY
+    if MEDIA_FIELD in used_kinds and "attachments" in tweet and "media_keys" in tweet["attachments"]:
+        media_info = media_lookup.get(tweet["attachments"]["media_keys"][0], EMPTY_ENTRY)
         
     # Check if the tweet contains any urls
     contains_url = None
     expanded_url = None
-    if "entities" in tweet and "urls" in tweet["entities"]:
+    if ((CONTAINS_URL_FIELD in used_kinds or EXPANDED_URL_FIELD in used_kinds)
+            and "entities" in tweet and "urls" in tweet["entities"]):
         contains_url = True
         expanded_url = tweet["entities"]["urls"][0].get("expanded_url")
     
-    row = list()
-    for field in fields:
-        if field.startswith("user."):
-            row.append(user_info.get(field))
-        elif field.startswith("tweet.place_"):
-            row.append(place_info.get(field))
-        elif field.startswith("tweet.media_"):
-            row.append(media_info.get(field))
-        elif field.startswith("reply."):
-            row.append(reply_info.get(field))
-        elif field == "tweet.reply_type":
-            row.append(reply_type)
-        elif field == "tweet.contains_url":
-            row.append(contains_url)
-        elif field == "tweet.expanded_url":
-            row.append(expanded_url)
-        elif field.startswith("tweet."):
-            field = field[6:]
-            if field in tweet:
-                row.append(tweet[field])
-            elif field in tweet["public_metrics"]:
-                row.append(tweet["public_metrics"][field])
-            else:
-                raise Exception('Unrecognized field: {}'.format(field))
-        else:
-            raise Exception('Unrecognized field: {}'.format(field))
-            
-    return row
+    return build_row(tweet, user_info, place_info, media_info, reply_info,
+                     reply_type, contains_url, expanded_url)
+
+
+@functools.lru_cache(maxsize=None)
+def make_row_builder(compiled_fields):
+    """Generates a function that builds a row from the information about a Tweet,
+    with the lookup for each field written out in order. This means that the kind
+    of each field does not have to be checked again for every Tweet.
+    
+    Arguments
+    ---------
+    compiled_fields: tuple((int, str)); the output of compile_fields(fields), as a tuple
+    
+    Returns
+    -------
+    build_row: function; takes the Tweet, its user, place, media and reply
+               dictionaries, its reply type, and whether it contains a URL and its
+               expanded URL, and returns a row to be written to CSV
+    """
+    sources = {
+        USER_FIELD: "user_info.get({key!r})",
+        PLACE_FIELD: "place_info.get({key!r})",
+        MEDIA_FIELD: "media_info.get({key!r})",
+        REPLY_FIELD: "reply_info.get({key!r})",
+        REPLY_TYPE_FIELD: "reply_type",
+        CONTAINS_URL_FIELD: "contains_url",
+        EXPANDED_URL_FIELD: "expanded_url",
+        TWEET_FIELD: "(tweet[{key!r}] if {key!r} in tweet else get_public_metric(tweet, {key!r}))"
+    }
+    cells = [sources[kind].format(key=key) for (kind, key) in compiled_fields]
+    source = ("def build_row(tweet, user_info, place_info, media_info, reply_info,\n"
+              "              reply_type, contains_url, expanded_url):\n"
+              "    return [{}]\n").format(", ".join(cells))
+    namespace = {"get_public_metric": get_public_metric}
+    exec(source, namespace)
+    return namespace["build_row"]
+
+
+def get_public_metric(tweet, key):
+    """Gets a field of a Tweet that is not at the top level, from its public metrics."""
+    if key in tweet["public_metrics"]:
+        return tweet["public_metrics"][key]
+    raise Exception('Unrecognized field: {}'.format(key))
     
 
-def make_reverse_lookup(entries, prefix, fields):
+def make_reverse_lookup(entries, prefix, fields, relevant_fields=None):
     """Creates a dictionary that can be used to look up entries by ID and get
     back a dictionary filtered to the relevant fields.
     
@@ -239,15 +464,18 @@ def make_reverse_lookup(entries, prefix, fields):
             included in the results
     fields: list(str); a list of fields to be extracted, only those of which with
             the designated prefix are relevant for these entries
+    relevant_fields: frozenset(str); the fields with the designated prefix, with the
+                     prefix removed, which are found from fields if not provided
     
     Returns
     -------
     entry_dict: id -> entry; a dictionary that maps from the "id" value to the
                 remaining designated fields of an entry
     """
-    relevant_fields = [field[len(prefix):] for field in fields if field.startswith(prefix)]
+    if relevant_fields is None:
+        relevant_fields = frozenset(field[len(prefix):] for field in fields if field.startswith(prefix))
     
-    entry_dict = {field: None for field in fields if field.startswith(prefix)}
+    entry_dict = dict()
     for entry in entries:
         relevant_entry = dict()
         for (key, value) in entry.items():
@@ -276,6 +504,8 @@ if __name__ == "__main__":
     parser.add_argument("in_path", metavar="INPUT", type=str, help="Path to the input .jsonl file")
     parser.add_argument("out_path", metavar="OUTPUT", type=str, help="Path to the output .csv file")
     parser.add_argument("--fields", type=str, nargs="+", help="Fields to extract.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes to use to extract fields.")
     args = parser.parse_args()
     
-    jsonl_to_csv(args.in_path, args.out_path, args.fields)
+    jsonl_to_csv(args.in_path, args.out_path, args.fields, workers=args.workers)
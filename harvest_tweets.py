@@ -74,12 +74,22 @@ be multiplied by a fixed multiplier, provided through the --count-multiplier arg
 from twarc.client2 import Twarc2
 from extract_tweets import jsonl_to_csv
 from count_timebins import bin_tweets_by_time, dump_counts
+from parallel_io import IO_BUFFER_SIZE
 from pathlib import Path
 import argparse
 import datetime
 import json
 import math
 
+# Use orjson to serialize results pages if it is available, since it is much faster
+try:
+    import orjson
+    dump_json = orjson.dumps
+except ImportError:
+    def dump_json(obj):
+        """Serializes an object to JSON bytes (like orjson.dumps)"""
+        return json.dumps(obj).encode("utf-8")
+
 
 def authenticate_api(keys_path="keys.json"):
     """Authenticates access to the Twitter API using Twarc2, based on API keys
@@ -144,21 +154,24 @@ def prepare_query(config_path="query_config.json",
     return query
 
 
-def update_query_for_timebin(query, bin_str, num_tweets):
+def update_query_for_timebin(query, bin_start, bin_end, num_tweets):
     """Updates the query (start/end times and results per page) for a timebin.
     Note: update is performed in-place.
     """
-    (bin_start, bin_end) = bin_str.split("_")
-    bin_start = datetime.datetime.fromisoformat(bin_start)
-    bin_end = datetime.datetime.fromisoformat(bin_end)
     query["start_time"] = bin_start
     query["end_time"] = bin_end
     query["max_results"] = min(max(num_tweets, 10), 500)
 
 
+def parse_bin_str(bin_str):
+    """Parses a timebin string (start_end, in ISO format) into its start and end datetimes."""
+    (bin_start, bin_end) = bin_str.split("_")
+    return (datetime.datetime.fromisoformat(bin_start), datetime.datetime.fromisoformat(bin_end))
+
+
 def harvest(api, query, out_jsonl, num_tweets=10000000):
     """Harvests a desired number of Tweets according to a query
-    and saves them to an open output JSONL file.
+    and saves them to an open output JSONL file (opened in binary mode).
     """
     search_results = api.search_all(**query)
     
@@ -168,7 +181,8 @@ def harvest(api, query, out_jsonl, num_tweets=10000000):
         page["data"] = page["data"][:(num_tweets - total_tweets)]
 
         # Write page to results file
-        out_jsonl.write(json.dumps(page) + "\n")
+        out_jsonl.write(dump_json(page))
+        out_jsonl.write(b"\n")
         total_tweets += len(page["data"])
         
         # Exit when all tweets are extracted
@@ -185,17 +199,18 @@ def harvest_bins(timebin_counts_path, api, query, out_jsonl, multiplier=1.25):
                          and the number of study Tweets in each timebin.
     api: an authenticated instance of the Twarc2 Twitter API.
     query: dict; a Twitter API query.
-    out_jsonl: file; an open JSONL file to save harvested Tweets.
+    out_jsonl: file; an open JSONL file to save harvested Tweets, in binary mode.
     multiplier: float; a multiplier for the number of tweets to harvest
                        in each timebin (provided count * multiplier)
     """
     with open(timebin_counts_path, encoding="utf-8") as in_file:
         bins = json.load(in_file)
-    total_bins = len(bins)
+    parsed_bins = [(parse_bin_str(bin_str), bin_size) for (bin_str, bin_size) in bins.items()]
+    total_bins = len(parsed_bins)
     
-    for (bin_number, (bin_str, bin_size)) in enumerate(bins.items()):
+    for (bin_number, ((bin_start, bin_end), bin_size)) in enumerate(parsed_bins):
         num_tweets = math.ceil(bin_size * multiplier)
-        update_query_for_timebin(query, bin_str, num_tweets)
+        update_query_for_timebin(query, bin_start, bin_end, num_tweets)
         if bin_number % 100 == 0:
             print("{} Starting bin {}/{}...".format(datetime.datetime.now().strftime("%d/%m %H:%M"), bin_number+1, total_bins))
         harvest(api, query, out_jsonl, num_tweets=num_tweets)
@@ -269,7 +284,7 @@ if __name__ == "__main__":
     query = prepare_query(config_path=pathify(args.config_name), 
                           include_path=pathify(args.include_name), exclude_path=pathify(args.exclude_name),
                           start_date=args.start_date, end_date=args.end_date)
-    with open(pathify(args.out_stem + ".jsonl"), "w", encoding="utf-8") as out_jsonl:
+    with open(pathify(args.out_stem + ".jsonl"), "wb", buffering=IO_BUFFER_SIZE) as out_jsonl:
         
         if args.purpose == "study":
             harvest(api, query, out_jsonl, num_tweets=args.max_tweets)
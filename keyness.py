@@ -18,13 +18,13 @@ across all bins) by providing the --include-bin-counts flag.
 
 from count_tweet_words import extract_words
 from align_corpora import get_timebin_start
+from count_timebins import parse_wall_times, EPOCH_DAYS, NS_PER_SECOND, SECONDS_PER_DAY
+from parallel_io import map_in_processes
 import argparse
 import datetime
 import dateutil.parser
-import csv
-from collections import Counter
 import pandas as pd
-from scipy.stats import chi2_contingency
+from scipy.special import xlogy
 import numpy as np
 import functools
 import re
@@ -59,13 +59,26 @@ STRFTIME_REGEX_MAPS = {
     "%u": r"\d",
     "%V": r"\d{2}"
 }
+# Matches (and captures) any of the strftime codes above, so they can all be replaced in one pass
+STRFTIME_CODE_RE = re.compile("({})".format("|".join(re.escape(format_code)
+                                                     for format_code in STRFTIME_REGEX_MAPS)))
+
+# Number of rows of the input CSV to read at a time
+CSV_CHUNK_SIZE = 100000
+NS_PER_DAY = SECONDS_PER_DAY * NS_PER_SECOND
+# Integer type for word counts (halving the memory of int64)
+COUNT_DTYPE = np.int32
+# Prefix of the names of timebins without timebin_formatting, and the pattern
+# they match (the prefix followed by an ISO format start time, so not e.g. bin_count)
+BIN_PREFIX = "bin_"
+BIN_PATTERN = re.compile(re.escape(BIN_PREFIX) + r"\d{4}-.+")
 
 
 def create_binned_wordcount_df(csv_filepath, corpora=("study", "reference"), col_sep="_",
                                tweet_col_suffix="tweet.text", use_bins=True, include_bin_counts=False,
                                timebin_unit="months",  timebin_interval=1, 
                                time_col_suffix="tweet.created_at", label_column="label", 
-                               keep_labels=None, exclude_terms=None, timebin_formatting=None):
+                               keep_labels=None, exclude_terms=None, timebin_formatting=None, workers=1):
     """Converts a CSV of tweets to a DataFrame of counts of distinct
     words in the tweets by bin, for a provided set of columns.
     
@@ -98,71 +111,187 @@ def create_binned_wordcount_df(csv_filepath, corpora=("study", "reference"), col
     timebin_formatting: str; the strftime format codes for naming the timebins.
                         If None, names the timebins as the ISO format timestamp
                         of the bin start time, prefixed by bin_
+    workers: int (default 1); the number of processes to count words in
     """
-    # Determine the function to use for getting timebin start time
+    # Weeks are binned as multiples of days
     if timebin_unit == "weeks":
         timebin_interval *= 7
         timebin_unit = "days"
-    if timebin_unit == "days":
-        get_starttime = get_timebin_start
-    else:
-        get_starttime = floor_large_time
     
-    all_counters = dict()
-    
-    with open(csv_filepath, encoding="utf-8") as in_file:
-        reader = csv.DictReader(in_file)
-        
-        for row in reader:
-            # Check label and skip row if required
-            if keep_labels is not None:
-                label = row[label_column]
-                if label not in keep_labels:
-                    continue
-            
-            # Count words for corpora
-            for corpus in corpora:
-                tweet = row[corpus + col_sep + tweet_col_suffix]
-                time = row[corpus + col_sep + time_col_suffix]
-                tweet_bin = "overall_count"
-                if use_bins:
-                    tweet_bin_starttime = get_starttime(time_str, timebin_unit, timebin_interval)
-                    if timebin_formatting is not None:
-                        tweet_bin = dateutil.parser.isoparse(tweet_bin_starttime).strftime(timebin_formatting)
-                    else:
-                        tweet_bin = "bin_" + tweet_bin_starttime
-                words = extract_words(tweet)
-                
-                # Exclude terms as required
-                if exclude_terms is not None:
-                    words = [word for word in words if word not in exclude_terms]
-                
-                # Update counter
-                if tweet_bin not in all_counters:
-                    all_counters[tweet_bin] = dict()
-                bin_counters = all_counters[tweet_bin]
-                if corpus not in bin_counters:
-                    bin_counters[corpus] = Counter()
-                bin_counters[corpus].update(words)
-    
-    # Convert to DataFrame with MultiIndex
-    counts_df = pd.DataFrame.from_dict({(tweet_bin, corpus): counter 
-                                        for (tweet_bin, bin_counter) in sorted(all_counters.items())
-                                        for (corpus, counter) in bin_counter.items()
-                                       }).fillna(0)
+    # Only read the columns that are needed
+    tweet_columns = {corpus: corpus + col_sep + tweet_col_suffix for corpus in corpora}
+    time_columns = {corpus: corpus + col_sep + time_col_suffix for corpus in corpora}
+    used_columns = list(tweet_columns.values())
+    if use_bins:
+        used_columns.extend(time_columns.values())
+    if keep_labels is not None:
+        used_columns.append(label_column)
+    
+    chunks = pd.read_csv(csv_filepath, usecols=used_columns, dtype=str, keep_default_na=False,
+                         chunksize=CSV_CHUNK_SIZE, encoding="utf-8")
+    # Skip rows with other labels if required
+    if keep_labels is not None:
+        chunks = (chunk[chunk[label_column].isin(keep_labels)] for chunk in chunks)
+    
+    # Count words for corpora in each chunk (in several processes, if required)
+    count_kwargs = dict(corpora=corpora, tweet_columns=tweet_columns, 
+                        time_columns=time_columns if use_bins else None, 
+                        timebin_unit=timebin_unit, timebin_interval=timebin_interval, 
+                        timebin_formatting=timebin_formatting, exclude_terms=exclude_terms)
+    if workers > 1:
+        chunk_counts = count_chunk_words_in_parallel(chunks, workers=workers, **count_kwargs)
+    else:
+        chunk_counts = (count_chunk_words(chunk, **count_kwargs) for chunk in chunks)
+    
+    word_counts = []
+    bin_columns = set()
+    for (chunk_word_counts, chunk_bin_columns) in chunk_counts:
+        word_counts.append(chunk_word_counts)
+        bin_columns.update(chunk_bin_columns)
+    
+    if not bin_columns:
+        raise Exception("No Tweets to count: {}".format(csv_filepath))
+    
+    # Convert to DataFrame with MultiIndex (columns are sorted by bin, then in corpus order)
+    word_counts = pd.concat(word_counts).groupby(level=[0, 1, 2], sort=False).sum()
+    columns = pd.MultiIndex.from_tuples([(tweet_bin, corpus) 
+                                         for tweet_bin in sorted({tweet_bin for (tweet_bin, _) in bin_columns})
+                                         for corpus in corpora if (tweet_bin, corpus) in bin_columns])
+    counts_df = (word_counts
+                 .unstack(level=[1, 2], fill_value=0)
+                 .reindex(columns=columns, fill_value=0)
+                 .rename_axis(index=None))
+    # Use a smaller integer type for the counts if no total can overflow it
+    if word_counts.sum() <= np.iinfo(COUNT_DTYPE).max:
+        counts_df = counts_df.astype(COUNT_DTYPE)
     
     # If not binning counts, return df that just contains overall counts;
     # if binning counts, add overall counts columns and (optionally) bin counts
+    # (every column is a bin until the overall counts are added)
     if use_bins:
-        add_overall_counts(counts_df, timebin_formatting=timebin_formatting)
+        add_overall_counts(counts_df, nonbin_columns=[])
         if include_bin_counts:
-            add_bin_counts(counts_df, timebin_formatting=timebin_formatting)
+            add_bin_counts(counts_df, nonbin_columns=["overall_count"])
     else:
-        counts_df = counts_df["overall_counts"]
+        counts_df = counts_df["overall_count"]
     
     return counts_df
 
 
+def count_chunk_words(chunk, corpora, tweet_columns, time_columns=None, timebin_unit="months",
+                      timebin_interval=1, timebin_formatting=None, exclude_terms=None):
+    """Counts the words in a chunk of Tweets paired across corpora. Returns a Series
+    of counts indexed by (word, bin, corpus), and the set of (bin, corpus) pairs
+    that the chunk has Tweets for.
+    
+    Arguments
+    ---------
+    chunk: DataFrame; the rows of the CSV file containing Tweets paired across corpora
+    corpora: iter(str); list of the corpus names
+    tweet_columns: dict; the name of the column containing Tweets for each corpus
+    time_columns: dict; the name of the column containing times at which Tweets
+                  were posted for each corpus (if None, Tweets are not binned, and
+                  are all counted in the bin overall_count)
+    timebin_unit: str (default "months"); the unit in which timebins are defined
+                  (valid options: "days", "months", "years")
+    timebin_interval: int (default 1); the number of time units to be included
+                      in a timebin (for months, must be a divisor of 12)
+    timebin_formatting: str; the strftime format codes for naming the timebins.
+                        If None, names the timebins as the ISO format timestamp
+                        of the bin start time, prefixed by bin_
+    exclude_terms: iter(str); list of terms to be excluded from counting
+    """
+    word_counts = []
+    bin_columns = set()
+    for corpus in corpora:
+        if time_columns is not None:
+            tweet_bins = get_timebin_names(chunk[time_columns[corpus]], timebin_unit, timebin_interval,
+                                           timebin_formatting=timebin_formatting)
+        else:
+            tweet_bins = np.full(len(chunk), "overall_count", dtype=object)
+        bin_columns.update((tweet_bin, corpus) for tweet_bin in pd.unique(tweet_bins))
+        
+        # One row per word token (Tweets without words give a missing word)
+        words_df = pd.DataFrame({"word": chunk[tweet_columns[corpus]].map(extract_words).to_numpy(),
+                                 "bin": tweet_bins, "corpus": corpus}).explode("word")
+        keep_words = words_df["word"].notna()
+        
+        # Exclude terms as required
+        if exclude_terms is not None:
+            keep_words &= ~words_df["word"].isin(exclude_terms)
+        
+        word_counts.append(words_df[keep_words].groupby(["word", "bin", "corpus"], sort=False).size())
+    return (pd.concat(word_counts), bin_columns)
+
+
+def count_chunk_words_in_parallel(chunks, workers=2, **kwargs):
+    """Generates the results of count_chunk_words() for an iter of chunks, in order,
+    counting several chunks in separate processes at once. Keyword arguments are 
+    passed on to count_chunk_words().
+    """
+    return map_in_processes(count_chunk_words, chunks, workers=workers, **kwargs)
+
+
+def get_timebin_names(time_strs, timebin_unit, timebin_interval=1, timebin_formatting=None):
+    """Returns an array of the names of the timebins that a column of times fall into.
+    Timebins are found for all of the times at once, and each timebin is only named
+    once (using get_timebin_name() on the first time that falls into it).
+    
+    Arguments
+    ---------
+    time_strs: pd.Series(str); ISO representations of the times
+    timebin_unit: str; the unit in which timebins are defined ("days" / "months" / "years")
+    timebin_interval: int (default 1); the number of time units to be included
+                      in a timebin (for months, must be a divisor of 12)
+    timebin_formatting: str; the strftime format codes for naming the timebins.
+                        If None, names the timebins as the ISO format timestamp
+                        of the bin start time, prefixed by bin_
+    """
+    times = None
+    if len(time_strs) > 0 and timebin_unit in ["days", "months", "years"]:
+        # Timebins are defined on local wall-clock time
+        times = parse_wall_times(time_strs)
+    if times is None:
+        return np.array([get_timebin_name(time_str, timebin_unit, timebin_interval, timebin_formatting)
+                         for time_str in time_strs], dtype=object)
+    
+    if timebin_unit == "days":
+        days = times.to_numpy(dtype="datetime64[ns]").view("i8") // NS_PER_DAY + EPOCH_DAYS
+        bin_keys = days // timebin_interval
+    elif timebin_unit == "months":
+        bin_keys = times.dt.year.to_numpy() * 12 + (times.dt.month.to_numpy() - 1) // timebin_interval
+    else:
+        bin_keys = (times.dt.year.to_numpy() - 1) // timebin_interval
+    
+    (_, first_indices, bin_indices) = np.unique(bin_keys, return_index=True, return_inverse=True)
+    bin_names = np.array([get_timebin_name(time_strs.iat[first_index], timebin_unit, timebin_interval,
+                                           timebin_formatting)
+                          for first_index in first_indices], dtype=object)
+    return bin_names[bin_indices]
+
+
+def get_timebin_name(time_str, timebin_unit, timebin_interval=1, timebin_formatting=None):
+    """Returns the name of the timebin that a time falls into.
+    
+    Arguments
+    ---------
+    time_str: str; ISO representation of a time
+    timebin_unit: str; the unit in which timebins are defined ("days" / "months" / "years")
+    timebin_interval: int (default 1); the number of time units to be included
+                      in a timebin (for months, must be a divisor of 12)
+    timebin_formatting: str; the strftime format codes for naming the timebins.
+                        If None, names the timebins as the ISO format timestamp
+                        of the bin start time, prefixed by bin_
+    """
+    if timebin_unit == "days":
+        timebin_starttime = get_timebin_start(time_str, timebin_unit, timebin_interval)
+    else:
+        timebin_starttime = floor_large_time(time_str, timebin_unit, timebin_interval)
+    if timebin_formatting is not None:
+        return dateutil.parser.isoparse(timebin_starttime).strftime(timebin_formatting)
+    return BIN_PREFIX + timebin_starttime
+
+
 def floor_large_time(time_str, timebin_unit, timebin_interval=1):
     """Rounds a time down to a bin by month or year
     
@@ -195,21 +324,23 @@ def floor_large_time(time_str, timebin_unit, timebin_interval=1):
     return floored_time.isoformat()
 
 
-def add_overall_counts(counts_df, corpus_level=1, **kwargs):
-    """Adds columns for the overall counts across bins for each word in each corpus."""
-    nonbin_columns = get_nonbin_columns(counts_df, **kwargs)
+def add_overall_counts(counts_df, corpus_level=1, nonbin_columns=None, **kwargs):
+    """Adds columns for the overall counts across bins for each word in each corpus.
+    The columns that are not bins can be given as nonbin_columns; if None, they are
+    found with get_nonbin_columns (which kwargs are passed on to).
+    """
+    if nonbin_columns is None:
+        nonbin_columns = get_nonbin_columns(counts_df, **kwargs)
     overall_counts = (counts_df
-                  .drop(nonbin_columns, axis=1)
-                  .groupby(level=corpus_level, axis=1, sort=False)
-                  .agg(lambda df: 
-                       apply_binned(df, lambda subdf: subdf.sum(axis=1), 
-                                    drop_level=corpus_level)
-                      )
-                 )
+                      .drop(nonbin_columns, axis=1)
+                      .T
+                      .groupby(level=corpus_level, sort=False)
+                      .sum()
+                      .T
+                     )
     counts_df[[("overall_count", corpus) for corpus in overall_counts.columns]] = overall_counts
 
 
-@functools.lru_cache(maxsize=None)
 def get_nonbin_columns(binned_df, bin_level=0, **kwargs):
     """Gets a list of the column names in a dataframe that do not represent bins"""
     columns = binned_df.columns
@@ -220,48 +351,46 @@ def get_nonbin_columns(binned_df, bin_level=0, **kwargs):
     return [column_name for column_name in column_names if not is_bin(str(column_name), **kwargs)]
 
 
-@functools.lru_cache(maxsize=None)
 def is_bin(column_name, timebin_formatting=None, **kwargs):
     """Indicates whether a column represents a bin"""
-    pattern = "bin_+"
+    pattern = BIN_PATTERN
     if timebin_formatting is not None:
         pattern = timebin_to_pattern(timebin_formatting)
-    return bool(re.fullmatch(pattern, column_name))
+    return bool(pattern.fullmatch(column_name))
 
 
 @functools.lru_cache(maxsize=None)
 def timebin_to_pattern(timebin_formatting):
-    """Converts a provided strftime format for a timebin into a regex pattern
-    that matches strings with that format
+    """Converts a provided strftime format for a timebin into a (compiled) regex
+    pattern that matches strings with that format
     """
-    pattern = timebin_formatting
-    for (format_code, re_pattern) in STRFTIME_REGEX_MAPS.items():
-        pattern = pattern.replace(format_code, re_pattern)
-    return pattern
-
-
-def apply_binned(grouped_df, func, drop_level=0, drop_axis=1, *args, **kwargs):
-    """Applies a function to a DataFrameGroupBy, by discarding a level of a multiindex."""
-    plain_df = grouped_df.droplevel(level=drop_level, axis=drop_axis)
-    return func(plain_df, *args, **kwargs)
-
-
-def add_bin_counts(counts_df, corpus_level=1, **kwargs):
-    """Adds columns that count the number of bins each word occurs in for each corpus."""
-    nonbin_columns = get_nonbin_columns(counts_df, **kwargs)
-    bin_counts = (counts_df
-                  .drop(nonbin_columns, axis=1)
-                  .groupby(level=corpus_level, axis=1, sort=False)
-                  .agg(lambda df: 
-                       apply_binned(df, lambda subdf: (subdf > 0).sum(axis=1), 
-                                    drop_level=corpus_level)
-                      )
+    # Splitting on the (captured) codes gives literal text at even positions, which
+    # is escaped, and codes at odd positions, which are replaced
+    pieces = STRFTIME_CODE_RE.split(timebin_formatting)
+    pattern = "".join(STRFTIME_REGEX_MAPS[piece] if index % 2 else re.escape(piece)
+                      for (index, piece) in enumerate(pieces))
+    return re.compile(pattern, re.ASCII)
+
+
+def add_bin_counts(counts_df, corpus_level=1, nonbin_columns=None, **kwargs):
+    """Adds columns that count the number of bins each word occurs in for each corpus.
+    The columns that are not bins can be given as nonbin_columns; if None, they are
+    found with get_nonbin_columns (which kwargs are passed on to).
+    """
+    if nonbin_columns is None:
+        nonbin_columns = get_nonbin_columns(counts_df, **kwargs)
+    bin_counts = ((counts_df.drop(nonbin_columns, axis=1) > 0)
+                  .T
+                  .groupby(level=corpus_level, sort=False)
+                  .sum()
+                  .T
+                  .astype(COUNT_DTYPE)
                  )
     counts_df[[("bin_count", corpus) for corpus in bin_counts.columns]] = bin_counts
 
 
 def score_keyness(counts, statistics=("g",), target_corpus="study", tidy_df=True,
-                  nan=False, **kwargs):
+                  nan=False, negatives=True):
     """Returns a DataFrame that augments word counts with keyness scores, based on 
     a designation of the name of the study corpus.
     
@@ -277,15 +406,22 @@ def score_keyness(counts, statistics=("g",), target_corpus="study", tidy_df=True
              sorting by keyness
     nan: bool; whether to use np.nan for cases where the word was not observed in
          either corpus (True), or instead use a keyness value of 0.0 (False)
+    negatives: bool; whether to set the keyness to be negative if the observed count
+               in the study corpus is lower than the expected count
     """
     if isinstance(statistics, str):
         statistics = (statistics,)
     
+    # The counts and their totals are shared by all of the statistics
+    observed = counts.to_numpy(dtype=np.float64)
+    totals = observed.sum(axis=0)
+    
     keyness_df = counts.copy()
     for statistic in statistics:
         keyness_df["keyness_" + statistic] = calculate_keyness_col(counts, statistic,
                                                                    target_corpus=target_corpus, 
-                                                                   nan=nan, **kwargs)
+                                                                   nan=nan, observed=observed, 
+                                                                   totals=totals, negatives=negatives)
     
     if tidy_df:
         keyness_df = keyness_df.reset_index().rename(columns={"index": "word"})
@@ -296,9 +432,10 @@ def score_keyness(counts, statistics=("g",), target_corpus="study", tidy_df=True
     return keyness_df
 
 
-def calculate_keyness_col(counts, statistic, target_corpus="study", nan=False, **kwargs):
+def calculate_keyness_col(counts, statistic, target_corpus="study", nan=False, observed=None,
+                          totals=None, negatives=True):
     """Calculates a column of keyness values from word counts, based on a designation of
-    the name of the study corpus.
+    the name of the study corpus. The statistic is calculated for all words at once.
     
     Arguments
     ---------
@@ -310,90 +447,81 @@ def calculate_keyness_col(counts, statistic, target_corpus="study", nan=False, *
                    has a column of counts with this name)
     nan: bool; whether to use np.nan for cases where the word was not observed in
          either corpus (True), or instead use a keyness value of 0.0 (False)
-    """
-    target_index = counts.columns.get_loc(target_corpus)
-    totals = tuple(counts.sum())
-    
-    keyness_col = counts.apply(
-        lambda row: calculate_keyness_statistic(row, totals, statistic, target_index=target_index,
-                                                nan=nan, **kwargs), 
-        axis=1)
-    
-    return keyness_col
-
-
-def calculate_keyness_statistic(counts, totals, statistic, target_index=0, 
-                                negatives=True, cache_sum_threshold=20, nan=False, **kwargs):
-    """Returns a designated keyness statistic based on counts of a given word, either by
-    retrieving it from a cache or calculating it anew.
-    
-    Arguments
-    ---------
-    counts: DataFrame; a row containing the counts for a given word across different
-            corpora
-    totals: tuple(int); a row containing the total counts across all words in each corpus
-    statistic: str; the statistic to calculate as a measure of keyness.
-               Currently only "g" (signed G-statistic) is available)
-    target_index: int; the index of the column that represents the study corpus
-    negatives: bool; whether to set the keyness statistic to be negative if the observed count
+    observed: np.ndarray(float); the counts as an N x C matrix, if already computed
+              (e.g. to share across statistics); if None, taken from counts
+    totals: np.ndarray(float); the total counts in each corpus, if already computed;
+            if None, summed from observed
+    negatives: bool; whether to set the keyness to be negative if the observed count
                in the study corpus is lower than the expected count
-    cache_sum_threshold: int; if the total count of the word across all corpora (i.e, the
-                         sum of counts) is less than or equal to this, the resulting
-                         keyness statistic will be looked up in a cache rather than calculated,
-                         to speed up processing of rare words
-    nan: bool; whether to use np.nan as the resultant G-statistic when the word was not
-         observed in either corpus (True), or use 0.0 (False)
-    """
-    total_count = counts.sum()
-    if total_count == 0:
-        if nan:
-            return np.nan
-        else:
-            return 0.0
     
-    if total_count <= cache_sum_threshold:
-        get_statistic = eval("_cache_signed_" + statistic)
-        return get_statistic(tuple(counts), totals, target_index=target_index,
-                             negatives=negatives, **kwargs)
-    
-    get_statistic = eval("_calculate_signed_" + statistic)
-    return get_statistic(counts, totals, target_index=target_index, negatives=negatives, **kwargs)
-
-
-def _calculate_signed_g(counts, totals, target_index=0, negatives=True, **kwargs):
-    """Calculates the G statistic for a row of counts, given a row of corresponding
-    total counts.
+    Raises ValueError if a corpus has no words at all (but some word was observed),
+    as the expected counts would then include zeros.
+    """
+    target_index = counts.columns.get_loc(target_corpus)
+    if observed is None:
+        observed = counts.to_numpy(dtype=np.float64)
+    if totals is None:
+        totals = observed.sum(axis=0)
+    
+    if statistic not in KEYNESS_STATISTICS:
+        raise Exception("Unknown statistic: {}".format(statistic))
+    get_statistic = KEYNESS_STATISTICS[statistic]
+    
+    # Words that were not observed in either corpus have no meaningful keyness,
+    # so the statistic is only calculated for the other words
+    observed_words = observed.sum(axis=1) > 0
+    keyness_values = np.full(len(observed), np.nan if nan else 0.0)
+    if observed_words.any():
+        if (totals == 0).any():
+            raise ValueError("Keyness cannot be calculated for a corpus with no words: {}"
+                             .format(list(counts.columns[totals == 0])))
+        keyness_values[observed_words] = get_statistic(observed[observed_words], totals,
+                                                       target_index=target_index,
+                                                       negatives=negatives)
+    
+    return pd.Series(keyness_values, index=counts.index)
+
+
+def _calculate_signed_g(observed, totals, target_index=0, negatives=True):
+    """Calculates the G statistic for every row of a matrix of counts, given a row
+    of corresponding total counts. For each word, this is the G statistic of the
+    2 x C contingency table formed by the word's counts and the totals (as given by
+    scipy.stats.chi2_contingency(table, correction=False, lambda_=0), with the terms
+    summed in the same order).
     
     Arguments
     ---------
-    counts: tuple(int); a row containing the counts for a given word across different
-            corpora
-    totals: tuple(int); a row containing the total counts across all words in each corpus
+    observed: np.ndarray(float); an N x C matrix containing the counts for each of
+              N words across C different corpora
+    totals: np.ndarray(float); a row containing the total counts across all words in each corpus
     target_index: int; the index of the column that represents the study corpus
     negatives: bool; whether to set the G-statistic to be negative if the observed count
                in the study corpus is lower than the expected count
     """
-    table = np.array([counts, totals])
-    (g, _, _, expected_table) = chi2_contingency(table, correction=False, lambda_=0)
+    # Observed and expected tables for each word, with shape N x 2 x C
+    tables = np.stack((observed, np.broadcast_to(totals, observed.shape)), axis=1)
+    row_totals = tables.sum(axis=2, keepdims=True)
+    column_totals = tables.sum(axis=1, keepdims=True)
+    expected_tables = row_totals * column_totals / tables.sum(axis=(1, 2), keepdims=True)
+    
+    terms = xlogy(tables, tables / expected_tables)
+    g = 2 * terms.reshape(len(tables), -1).sum(axis=1)
     
     if negatives:
-        observed_target = counts[target_index]
-        expected_target = expected_table[0][target_index]
-        if observed_target < expected_target:
-            g = -g
+        underrepresented = observed[:, target_index] < expected_tables[:, 0, target_index]
+        g[underrepresented] = -g[underrepresented]
     
     return g
 
 
-@functools.lru_cache(maxsize=None)
-def _cache_signed_g(counts, totals, target_index=0, negatives=True, **kwargs):
-    """Uses caching to speed up the calculation of signed G."""  
-    return _calculate_signed_g(counts, totals, target_index=target_index,
-                               negatives=negatives, **kwargs)
+# Mapping between statistic names and the functions that calculate them
+KEYNESS_STATISTICS = {
+    "g": _calculate_signed_g
+}
 
 
 def score_keyness_per_bin(counts_df, statistics=("g",), bin_level=0, target_corpus="study",
-                          nan=True, **kwargs):
+                          nan=True, negatives=True, nonbin_columns=None, **kwargs):
     """Returns a DataFrame with keyness scores for each word, for each timebin.
     
     Arguments
@@ -409,30 +537,36 @@ def score_keyness_per_bin(counts_df, statistics=("g",), bin_level=0, target_corp
                    has a column of counts with this name)
     nan: bool; whether to use np.nan for cases where the word was not observed in
          either corpus (True), or instead use a keyness value of 0.0 (False)
+    negatives: bool; whether to set the keyness to be negative if the observed count
+               in the study corpus is lower than the expected count
+    nonbin_columns: list(str); the columns that are not bins; if None, they are found
+                    with get_nonbin_columns
+    kwargs: passed on to get_nonbin_columns (e.g. timebin_formatting)
     """
+    if nonbin_columns is None:
+        nonbin_columns = get_nonbin_columns(counts_df, bin_level=bin_level, **kwargs)
     # We do want keyness for overall_count, just not other things
-    nonbin_columns = get_nonbin_columns(counts_df, bin_level=bin_level, **kwargs)
     nonbin_columns = [column_name for column_name in nonbin_columns if not column_name.endswith("_count")]
     
-    # Get DataFrame with keyness but no nonbin columns
-    df_with_bin_keyness = (counts_df
-                           .drop(nonbin_columns, axis=1)
-                           .groupby(level=bin_level, axis=1, sort=False)
-                           .apply(lambda df: 
-                                  apply_binned(df, score_keyness, statistics=statistics, 
-                                               target_corpus=target_corpus, nan=nan, 
-                                               tidy_df=False, **kwargs)
-                                 )
-                          )
-    
-    # Add the nonbin columns back in
-    nonbin_df = counts_df[nonbin_columns]
-    df_with_bin_keyness = df_with_bin_keyness.merge(nonbin_df, how="left", left_index=True, right_index=True)
-
+    # Get DataFrame with keyness but no nonbin columns, one bin at a time
+    bin_keyness_dfs = dict()
+    for bin_name in counts_df.columns.unique(level=bin_level):
+        if bin_name not in nonbin_columns:
+            bin_counts_df = counts_df.xs(bin_name, axis=1, level=bin_level)
+            bin_keyness_dfs[bin_name] = score_keyness(bin_counts_df, statistics=statistics,
+                                                      target_corpus=target_corpus, nan=nan,
+                                                      tidy_df=False, negatives=negatives)
+    df_with_bin_keyness = pd.concat(bin_keyness_dfs, axis=1)
+    
+    # Add the nonbin columns back in (the rows are already aligned)
+    if nonbin_columns:
+        df_with_bin_keyness = pd.concat([df_with_bin_keyness, counts_df[nonbin_columns]], axis=1)
+    
     return df_with_bin_keyness
 
 
-def save_df(keyness_df, output_path, flatten=True, flat_col_sep=".", sort_by="keyness_g"):
+def save_df(keyness_df, output_path, flatten=True, flat_col_sep=".", sort_by="keyness_g",
+            use_pyarrow=False):
     """Saves a keyness DataFrame to CSV.
     
     Arguments
@@ -445,7 +579,14 @@ def save_df(keyness_df, output_path, flatten=True, flat_col_sep=".", sort_by="ke
     flat_col_sep: str; the separator to use between multiindex values when creating
                   flattened column names
     sort_by: str; name of the column to sort by (with ties broken alphabetically)
+    use_pyarrow: bool; if True, writes the CSV with PyArrow, which is much faster for
+                 wide DataFrames but formats the file differently from to_csv (all
+                 strings are quoted, and floats are written in PyArrow's own format).
+                 Requires pyarrow to be installed, and the columns to be flat
     """
+    if use_pyarrow and not flatten and isinstance(keyness_df.columns, pd.core.indexes.multi.MultiIndex):
+        raise Exception("use_pyarrow requires flattened columns")
+    
     # Get the column index value on which to sort
     if isinstance(keyness_df.columns, pd.core.indexes.multi.MultiIndex):
         if flatten:
@@ -458,13 +599,17 @@ def save_df(keyness_df, output_path, flatten=True, flat_col_sep=".", sort_by="ke
         keyness_df.columns = [flat_col_sep.join(multicol_levels)
                               for multicol_levels in keyness_df.columns.values]
     
-    # Save DataFrame to CSV
-    df_to_save = (
-        keyness_df
-        .reset_index(names="word")
-        .sort_values([sort_by, "word"], ascending=[False, True], ignore_index=True)
-    )
-    df_to_save.to_csv(output_path, index=False, encoding="utf-8")
+    # Save DataFrame to CSV, sorted with a single lexsort (descending by sort_by,
+    # then ascending by word; missing values go last, as with sort_values)
+    df_to_save = keyness_df.reset_index(names="word")
+    sort_order = np.lexsort((df_to_save["word"].to_numpy(), -df_to_save[sort_by].to_numpy()))
+    df_to_save = df_to_save.take(sort_order).reset_index(drop=True)
+    if use_pyarrow:
+        import pyarrow
+        import pyarrow.csv
+        pyarrow.csv.write_csv(pyarrow.Table.from_pandas(df_to_save, preserve_index=False), output_path)
+    else:
+        df_to_save.to_csv(output_path, index=False, encoding="utf-8")
 
 
 if __name__ == "__main__":
@@ -525,6 +670,10 @@ if __name__ == "__main__":
     parser.add_argument("--nan", dest="nan", action="store_true", help="Use numpy.nan for keyness when a word \
                         does not occur in either corpus (as opposed to 0.0, which is used if this flag is not \
                         provided)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes to count words in")
+    parser.add_argument("--pyarrow-csv", dest="use_pyarrow", action="store_true", help="Write the output \
+                        CSV with PyArrow (must be installed), which is much faster for wide outputs, but \
+                        quotes all strings and formats numbers differently from the default writer")
     
     args = parser.parse_args()
     
@@ -541,14 +690,18 @@ if __name__ == "__main__":
                                            include_bin_counts=args.include_bin_counts, timebin_unit=args.timebin_unit,
                                            timebin_interval=args.timebin_interval, time_col_suffix=args.time_col_suffix,
                                            label_column=args.label_column, keep_labels=args.keep_labels,
-                                           exclude_terms=exclude_terms, timebin_formatting=args.timebin_formatting)
+                                           exclude_terms=exclude_terms, timebin_formatting=args.timebin_formatting,
+                                           workers=args.workers)
     
     # Get keyness statistics
     if args.use_bins:
+        # The overall (and bin) counts are the only columns that are not bins
+        nonbin_columns = ["overall_count"] + (["bin_count"] if args.include_bin_counts else [])
         keyness_df = score_keyness_per_bin(counts_df, target_corpus=args.target_corpus, nan=args.nan,
-                                           timebin_formatting=args.timebin_formatting)
+                                           negatives=args.negatives, nonbin_columns=nonbin_columns)
     else:
-        keyness_df = score_keyness(counts_df, target_corpus=args.target_corpus, tidy_df=False, nan=args.nan)
+        keyness_df = score_keyness(counts_df, target_corpus=args.target_corpus, tidy_df=False, nan=args.nan,
+                                   negatives=args.negatives)
     
     # Save results to CSV
-    save_df(keyness_df, args.output_path)
\ No newline at end of file
+    save_df(keyness_df, args.output_path, use_pyarrow=args.use_pyarrow)
\ No newline at end of file
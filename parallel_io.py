@@ -0,0 +1,39 @@
+"""
+===============================================================================
+PARALLEL_IO.PY
+Authors: Simon Todd & Chloe Willis
+
+This code contains the file buffering and worker process settings that are
+shared by the other scripts, which import it. It does not have to be used directly.
+===============================================================================
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Buffer size (in bytes) for reading and writing large files
+IO_BUFFER_SIZE = 1 << 20
+
+
+def map_in_processes(function, chunks, workers=2, **kwargs):
+    """Generates the results of applying a function to each of an iter of chunks,
+    in order, with several chunks processed in separate processes at once. Only a
+    few chunks are read ahead of the one whose result is being yielded, so that the
+    whole input is not held in memory.
+
+    Arguments
+    ---------
+    function: function; the function to apply to each chunk (must be picklable,
+              i.e. defined at the top level of a module)
+    chunks: iter; the chunks to apply the function to
+    workers: int; number of worker processes
+    kwargs: passed on to the function, along with each chunk
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(function, chunk, **kwargs))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()